@@ -1,9 +1,15 @@
 # System imports
 import csv
+import re
 import pandas as pd
 import numpy as np
 from pathlib import Path
 
+# Commsec trade details look like `B 830 RBL @ 2`
+COMMSEC_TRADE = re.compile(
+    r'^(?P<TradeType>[BS])\s+(?P<Volume>\d+(?:\.\d*)?)\s+(?P<Ticker>\S+)\s+@\s+(?P<TradePrice>\d*\.?\d+)\s*$'
+)
+
 class DataPath:
     data_path = Path(__file__).parents[1] / 'data'
     def __init__(self):
@@ -82,35 +88,17 @@ class Trades(DataPath):
         Arguments:
             df {Dataframe} -- Raw transactions.csv loaded into a dataframe
         """
-        details = df['Details'].tolist()
-        trades = []
-
-        # Split details data
-        for detail in details:
-            if detail[0] in ['B','S']:  # Trades start with B or S
-                detail = detail.split()
-                for i,txt in enumerate(detail):
-                    if txt == '@':
-                        detail.pop(i)
-            else:
-                detail = np.nan  # Mark non-trade details as NaN
-            trades.append(detail)
-
-        # Keep only trade transactions
-        df['Trades'] = trades
-        df = df[df.Trades.notnull()]
-
-        # Flatten list of trade data to columns
-        temp_df = df.Trades.apply(pd.Series)
-        temp_df.columns = ['TradeType','Volume','Ticker','TradePrice']
-        df = df.join(temp_df)
+        # Split details data in one regex pass, keeping only trade transactions (trades start with B or S)
+        trades = df['Details'].astype(str).str.extract(COMMSEC_TRADE)
+        trades = trades[trades['TradeType'].notna()]
+        df = df.loc[trades.index].join(trades)
 
         # Convert string dates to datetime via pandas
         df.Date = pd.to_datetime(df.Date, dayfirst=True)
 
         # Change str to float
-        df['Volume'] = pd.to_numeric(df['Volume'], downcast='float')
-        df['TradePrice'] = pd.to_numeric(df['TradePrice'], downcast='float')
+        df['Volume'] = pd.to_numeric(df['Volume'])
+        df['TradePrice'] = pd.to_numeric(df['TradePrice'])
         
         # Assign negative signs to volume if trades are sells
         df['Volume'] = np.where(df['TradeType']=='S', df['Volume']*-1,df['Volume'])
@@ -1,18 +1,256 @@
-from transactions import tx_loader
-from analysis import tax, performance
+'''TaxJinie command line
 
-def main():
-    commsec = tx_loader.Loader()
-    commsec.build()
+    python taxjinie                    Runs every stage: ingest, cgt, discounts, export, cashflows
+    python taxjinie ingest             [--full] [--all-exports] [--chunksize N] [--workers N]
+    python taxjinie cgt                [--fy 2022] [--output csv|excel] [--method lifo|fifo|hifo|mintax] [--compare] [--full] [--workers N]
+    python taxjinie discounts          [--days 365]
+    python taxjinie export
+    python taxjinie cashflows          [--ticker CBA] [--freq W|M|Q|FY]
+    python taxjinie bench              [--rows N]
+    python taxjinie batch ROOT [ROOT ...] [--fy 2022] [--method ...] [--output csv|excel] [--workers N] [--no-ingest]
 
-    tax_reporting = tax.Tax(2022)
-    tax_reporting.capital_gain_events()
-    tax_reporting.upcoming_cgtdiscounts()
-    tax_reporting.cgt_report(output_type='excel')
-    tax_reporting.export_tx_history()
+Each command only imports what it needs. Ingest is skipped without loading pandas while the raw files are
+unchanged, and report stages are skipped while the transaction store is unchanged since they last ran and
+the reports they wrote are still there (use --force to rerun). Add --timing to check a run against
+COLD_START_BUDGET.
+'''
+from datetime import date
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import os
+import time
 
-    performance_reporting = performance.Performance()
-    performance_reporting.monthly_cashflows(export=True)
+START = time.perf_counter()  # Fallback for `elapsed` where the process start time is not available
+
+ROOT = Path(__file__).parent
+DATA_DIR = ROOT / 'transactions'
+STORE_DIR = DATA_DIR / 'store'
+INGEST_STATE = DATA_DIR / '.ingest' / 'state.json'
+REPORTS_DIR = ROOT / 'reports'
+STAGES = REPORTS_DIR / '.stages.json'
+
+COLD_START_BUDGET = {  # Seconds from CLI start to finish
+    'ingest': 0.1,  # Raw files unchanged
+    'cgt': 3.0,
+    'discounts': 3.0,
+    'export': 3.0,
+    'cashflows': 3.0,
+}
+
+def last_financial_year():
+    today = date.today()
+    return today.year if today.month > 6 else today.year - 1
+
+def store_signature():
+    '''Returns:
+        str: Hash of the size and mtime of every store partition's metadata, which change whenever the store is written
+    '''
+    metas = sorted(STORE_DIR.glob('FY*/meta.json'))
+    stats = [(meta.parent.name, meta.stat().st_mtime_ns, meta.stat().st_size) for meta in metas]
+    return hashlib.sha1(json.dumps(stats).encode()).hexdigest()
+
+def elapsed():
+    '''Returns:
+        float: Seconds since the process started, including interpreter start-up where /proc is available
+            (Linux), otherwise since this module was imported
+    '''
+    try:
+        # Field 22 of /proc/self/stat is the start time in clock ticks since boot, counted after the command name
+        start_ticks = int(Path('/proc/self/stat').read_text().rsplit(')', 1)[1].split()[19])
+        uptime = float(Path('/proc/uptime').read_text().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.perf_counter() - START
+
+def report_files():
+    '''Returns:
+        dict: {path relative to REPORTS_DIR: mtime} of every report file
+    '''
+    return {
+        str(fpath.relative_to(REPORTS_DIR)): fpath.stat().st_mtime_ns
+        for fpath in REPORTS_DIR.rglob('*') if fpath.is_file() and fpath != STAGES
+    }
+
+def run_stage(stage, force, report):
+    '''Runs `report` unless it already ran against the current transaction store and the files it wrote are
+    still in REPORTS_DIR
+    '''
+    REPORTS_DIR.mkdir(exist_ok=True)
+    stages = json.loads(STAGES.read_text()) if STAGES.exists() else {}
+    signature = store_signature()
+
+    last_run = stages.get(stage)
+    if not force and isinstance(last_run, dict) and last_run['signature'] == signature:
+        missing = [name for name in last_run['outputs'] if not (REPORTS_DIR / name).exists()]
+        if not missing:
+            print(f'{stage}: transactions unchanged since last run, skipping (use --force to rerun)')
+            return
+        print(f'{stage}: rerunning for missing reports: {", ".join(missing)}')
+
+    before = report_files()
+    report()
+    outputs = [name for name, mtime in report_files().items() if before.get(name) != mtime]
+    stages[stage] = {'signature': signature, 'outputs': outputs}
+    STAGES.write_text(json.dumps(stages, indent=2))
+
+def raw_files_unchanged(all_exports):
+    '''Checks raw file sizes and mtimes against the last ingest, without importing pandas
+    '''
+    if not INGEST_STATE.exists() or not any(STORE_DIR.glob('FY*/meta.json')):
+        return False
+
+    from transactions import brokers  # Lists adapters without importing them
+    state = json.loads(INGEST_STATE.read_text())
+
+    sources = [broker for broker in brokers.names() if any(DATA_DIR.glob(f'{broker}*csv'))] + ['dividends']
+    if set(state) != set(sources):  # A broker's exports were added or deleted since the last ingest
+        return False
+    for source in sources:
+        raw_paths = sorted(DATA_DIR.glob(f'{source}*csv'))
+        raw_paths = raw_paths if all_exports else raw_paths[-1:]
+        previous = state.get(source, {})
+
+        if not raw_paths or set(previous) != {fpath.name for fpath in raw_paths}:
+            return False
+        for fpath in raw_paths:
+            stat = fpath.stat()
+            if (stat.st_size, stat.st_mtime_ns) != (previous[fpath.name]['size'], previous[fpath.name]['mtime_ns']):
+                return False
+
+    return True
+
+def ingest(args):
+    if not args.full and raw_files_unchanged(args.all_exports):
+        print('Transactions up to date, nothing to ingest')
+        return
+
+    from transactions import tx_loader
+    tx_loader.Loader().build(
+        incremental=not args.full, all_exports=args.all_exports, workers=args.workers, chunksize=args.chunksize
+    )
+
+def cgt(args):
+    def report():
+        from analysis import tax
+        tax_reporting = tax.Tax(args.fy)
+        if args.compare:
+            tax_reporting.compare_methods()
+        tax_reporting.capital_gain_events(method=args.method, incremental=not args.full, workers=args.workers)
+        tax_reporting.fy_view()
+        tax_reporting.cgt_report(output_type=args.output)
+
+    run_stage(f'cgt FY{args.fy} {args.output} {args.method}', args.force or args.compare, report)
+
+def discounts(args):
+    def report():
+        from analysis import tax
+        # Open lots as of today, so the history runs to the end of the current financial year
+        tax.Tax(last_financial_year() + 1).upcoming_cgtdiscounts(days=args.days, export=True)
+
+    run_stage(f'discounts {date.today():%Y%m%d} {args.days}', args.force, report)
+
+def export(args):
+    def report():
+        from analysis import tax
+        tax.Tax(last_financial_year()).export_tx_history()
+
+    run_stage(f'export {date.today():%Y%m%d}', args.force, report)
+
+def cashflows(args):
+    def report():
+        from analysis import performance
+        performance.Performance().cashflows(args.freq, ticker=args.ticker, export=True)
+
+    run_stage(f'cashflows {args.ticker} {args.freq}', args.force, report)
+
+def batch(args):
+    from analysis import batch as client_book
+    client_book.run(
+        args.roots, args.fy, method=args.method, output_type=args.output, workers=args.workers,
+        ingest_first=not args.no_ingest,
+    )
+
+def bench(args):
+    from transactions import benchmark
+    benchmark.benchmark(rows=args.rows)
+
+def run_all(args):
+    ingest(args)
+    cgt(args)
+    discounts(args)
+    export(args)
+    cashflows(args)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='taxjinie', description='Portfolio tax and performance reporting')
+    parser.add_argument('--timing', action='store_true', help='Report run time against the cold-start budget')
+    # Also accepted after the command. Suppressed by default, so it does not undo a --timing given before it
+    timing = argparse.ArgumentParser(add_help=False)
+    timing.add_argument('--timing', action='store_true', default=argparse.SUPPRESS,
+                        help='Report run time against the cold-start budget')
+    parser.set_defaults(command=run_all, full=False, all_exports=False, workers=None, chunksize=None,
+                        fy=last_financial_year(), output='excel', method='lifo', compare=False, ticker='portfolio',
+                        freq='M', days=365, force=False)
+    commands = parser.add_subparsers(title='commands')
+
+    ingest_parser = commands.add_parser('ingest', parents=[timing], help='Load new broker and dividend transactions')
+    ingest_parser.add_argument('--full', action='store_true', help='Rebuild the store from scratch')
+    ingest_parser.add_argument('--all-exports', action='store_true', help='Merge every export, not only the latest')
+    ingest_parser.add_argument('--workers', type=int, help='Processes used to read exports')
+    ingest_parser.add_argument('--chunksize', type=int, help='Stream raw files in chunks of this many rows')
+    ingest_parser.set_defaults(command=ingest)
+
+    for name, command, help_text in [
+        ('cgt', cgt, 'Capital gains report for a financial year'),
+        ('discounts', discounts, 'Parcels becoming eligible for the CGT discount'),
+        ('export', export, 'Export the full transaction history'),
+        ('cashflows', cashflows, 'Cashflows report per ticker and period'),
+    ]:
+        report_parser = commands.add_parser(name, parents=[timing], help=help_text)
+        report_parser.add_argument('--force', action='store_true', help='Rerun even if transactions are unchanged')
+        report_parser.set_defaults(command=command)
+
+    commands.choices['cgt'].add_argument('--fy', type=int, default=last_financial_year(),
+                                         help='Financial year end, e.g. 2022 for FY2021-22 (default: last completed)')
+    commands.choices['cgt'].add_argument('--output', choices=['csv', 'excel'], default='excel')
+    commands.choices['cgt'].add_argument('--method', choices=['lifo', 'fifo', 'hifo', 'mintax'], default='lifo',
+                                         help='Cost basis method, mintax minimises the taxable gain of each sale')
+    commands.choices['cgt'].add_argument('--compare', action='store_true', help='Also print totals under each method and the saving versus LIFO')
+    commands.choices['cgt'].add_argument('--full', action='store_true', help='Rematch every ticker instead of resuming from checkpoints')
+    commands.choices['cgt'].add_argument('--workers', type=int, help='Processes to share tickers across')
+    commands.choices['discounts'].add_argument('--days', type=int, default=365,
+                                               help='Look this many days ahead (default: 365)')
+    commands.choices['cashflows'].add_argument('--ticker', default='portfolio')
+    commands.choices['cashflows'].add_argument('--freq', choices=['W', 'M', 'Q', 'FY'], default='M',
+                                               help='Weekly, monthly, quarterly or financial year cashflows')
+
+    batch_parser = commands.add_parser('batch', parents=[timing], help='Capital gains reports for many client portfolios in one run')
+    batch_parser.add_argument('roots', nargs='+', type=Path, help='Portfolio folders laid out like transactions/')
+    batch_parser.add_argument('--fy', type=int, default=last_financial_year())
+    batch_parser.add_argument('--method', choices=['lifo', 'fifo', 'hifo', 'mintax'], default='lifo')
+    batch_parser.add_argument('--output', choices=['csv', 'excel'], default='csv')
+    batch_parser.add_argument('--workers', type=int, help='Processes used to ingest and match')
+    batch_parser.add_argument('--no-ingest', action='store_true', help='Use the stores as they are')
+    batch_parser.set_defaults(command=batch)
+
+    bench_parser = commands.add_parser('bench', parents=[timing], help='Broker adapter ingest throughput')
+    bench_parser.add_argument('--rows', type=int, default=1_000_000)
+    bench_parser.set_defaults(command=bench)
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.command(args)
+
+    if args.timing:
+        name = args.command.__name__
+        seconds = elapsed()
+        budget = COLD_START_BUDGET.get(name)
+        verdict = '' if budget is None else f' (budget {budget:.1f}s: {"ok" if seconds <= budget else "OVER"})'
+        print(f'{name} took {seconds:.3f}s{verdict}')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,123 @@
+'''Capital gains for a book of client portfolios in one run
+
+Each client is a portfolio root laid out like `transactions/`: broker exports and dividends, plus the store and
+ingest state built from them. Roots are ingested incrementally, then every client's transactions are stacked into
+one book with a Portfolio column and matched in a single sharded pass of the lot engine, with lots keyed by
+(portfolio, ticker). Reports are written per client:
+
+    reports/clients/<portfolio>/FY2022_cgt_report.csv
+    reports/clients/FY2022_cgt_summary.csv
+'''
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import pandas as pd
+import numpy as np
+
+# Local imports
+from transactions import tx_loader
+from . import portfolio, lots, tax
+
+CLIENT_REPORTS_DIR = tax.REPORTS_DIR / 'clients'
+
+def ingest(roots, workers=None):
+    '''Incrementally ingests each portfolio root, in a process pool when there are several
+    '''
+    if len(roots) == 1:
+        _ingest(roots[0])
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(_ingest, roots))
+
+def _ingest(root):
+    tx_loader.Loader(root).build(incremental=True)
+
+def book_transactions(roots, financial_year):
+    '''Stacks the CGT columns of every portfolio root, up to the end of `financial_year`
+
+    Returns:
+        pandas.DataFrame: Transactions with a Portfolio column named after each root's folder
+    '''
+    names = [Path(root).name for root in roots]
+    if len(set(names)) != len(names):
+        raise ValueError('Portfolio roots must have unique folder names')
+
+    frames = [
+        portfolio.transactions(tax.CGT_COLUMNS, end=f'{financial_year}-06-30', data_dir=root) for root in roots
+    ]
+    return pd.concat(frames).assign(
+        Portfolio=pd.Categorical.from_codes(np.repeat(np.arange(len(frames)), [len(frame) for frame in frames]), names)
+    )
+
+def cgt_book(book_df, financial_year, method='lifo', workers=None):
+    '''Matches every portfolio in a book in one pass, with lots kept apart per (portfolio, ticker)
+
+    Args:
+        book_df (pandas.DataFrame): Transactions with a Portfolio column and tax.CGT_COLUMNS
+        financial_year (int): Financial year end
+        method (str, optional): Cost basis method, one of `lots.METHODS` except 'specific'. Defaults to 'lifo'.
+        workers (int, optional): Processes to shard tickers across, see `lots.match_parallel`
+
+    Returns:
+        dict: {portfolio: (transactions, lots.AuditLog, open lots)}, with plain tickers
+    '''
+    # Portfolio and ticker share one key, so each client's tickers are separate lot stores in the engine
+    keys = book_df['Portfolio'].astype(str) + '/' + book_df['Ticker'].astype(str)
+    book_tax = tax.Tax(financial_year, transactions=book_df.assign(Ticker=keys))
+    book_tax.capital_gain_events(method=method, workers=workers)
+
+    audit, open_lots = book_tax.audit, book_tax.open_lots
+    sale_portfolios, sale_tickers = _split_keys(audit.sales['Ticker'])
+    plain_audit = lots.AuditLog(
+        audit.sales.assign(Ticker=sale_tickers), audit.parcels.assign(Ticker=_split_keys(audit.parcels['Ticker'])[1]),
+        audit.links,
+    )
+    audits = plain_audit.split(sale_portfolios)
+    lot_portfolios, lot_tickers = _split_keys(open_lots['Ticker'])
+    open_lots_by = open_lots.assign(Ticker=lot_tickers).groupby(lot_portfolios, sort=False)
+
+    clients = {}
+    for name, client_df in book_df.groupby('Portfolio', observed=True, sort=False):
+        client_audit = audits[name] if name in audits else plain_audit.select(np.zeros(len(plain_audit), dtype=bool))
+        client_lots = open_lots_by.get_group(name) if name in open_lots_by.groups else open_lots.iloc[:0]
+        clients[name] = (client_df.drop(columns='Portfolio'), client_audit, client_lots)
+    return clients
+
+def _split_keys(keys):
+    # 'portfolio/ticker' keys -> (portfolio, ticker) of each row, splitting each distinct key once
+    codes, uniques = pd.factorize(keys)
+    if len(uniques) == 0:
+        return np.array([], dtype=object), np.array([], dtype=object)
+
+    parts = pd.Series(np.asarray(uniques, dtype=str)).str.split('/', n=1, expand=True)
+    return parts[0].to_numpy()[codes], parts[1].to_numpy()[codes]
+
+def run(roots, financial_year, method='lifo', output_type='csv', workers=None, ingest_first=True,
+        reports_dir=CLIENT_REPORTS_DIR):
+    '''Ingests every portfolio root, matches the whole book and writes each client's CGT report, plus one summary
+    of the book
+
+    Returns:
+        pandas.DataFrame: Capital Gains and Capital Gains Taxable for the financial year per portfolio
+    '''
+    roots = [Path(root) for root in roots]
+    if ingest_first:
+        ingest(roots, workers)
+
+    summary = {}
+    clients = cgt_book(book_transactions(roots, financial_year), financial_year, method, workers)
+    for name, (client_df, audit, lots_df) in clients.items():
+        client_tax = tax.Tax(financial_year, transactions=client_df, reports_dir=reports_dir / name)
+        client_tax.load_audit(audit, lots_df, method)
+        client_tax.cgt_report(output_type=output_type)
+
+        fy_df = client_tax.all_cg_events.loc[f'{financial_year - 1}-07-01':f'{financial_year}-06-30']
+        summary[name] = fy_df[['Capital Gains', 'Capital Gains Taxable']].sum()
+
+    summary_df = pd.DataFrame(summary, index=['Capital Gains', 'Capital Gains Taxable']).T.rename_axis('Portfolio')
+    reports_dir.mkdir(parents=True, exist_ok=True)
+    summary_df.to_csv(reports_dir / f'FY{financial_year}_cgt_summary.csv')
+    print(f'Capital gains for \tFY{financial_year - 1}-{financial_year}, {len(summary_df)} portfolios ({method.upper()})')
+    print(f'Saved!\n\tFilename:\tFY{financial_year}_cgt_summary.csv\n\tOutput path:\t{reports_dir}')
+
+    return summary_df
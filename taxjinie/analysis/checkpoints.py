@@ -0,0 +1,146 @@
+'''Checkpoints of capital gains matching, for incremental runs
+
+After each financial year, the open lots of every ticker and the year's audit log (see `lots.AuditLog`) are
+saved per cost basis method, with a digest of each ticker's transactions in the year:
+
+    transactions/.cgt/lifo/FY2021_lots.npz, FY2021_sales.npz, FY2021_parcels.npz, FY2021_links.npz, FY2021.json
+
+A run compares digests to find the first year each ticker changed in, and rematches only those tickers, from
+the checkpoint of the year before. A daily run therefore only rematches the tickers that traded, from the
+start of the current year, and reuses the saved audit logs of everything else.
+'''
+import json
+import numpy as np
+import pandas as pd
+
+# Local imports
+from transactions import store
+from . import portfolio, lots
+
+CHECKPOINT_DIR = portfolio.DATA_DIR / '.cgt'
+
+def fy_digests(txs_df):
+    '''Returns:
+        dict: {financial year: {ticker: digest of the ticker's transactions in the year}}
+    '''
+    rows = pd.DataFrame({
+        'FY': store.financial_year(txs_df.index),
+        'Ticker': txs_df['Ticker'].astype(str).to_numpy(),
+        'Hash': pd.util.hash_pandas_object(txs_df, index=True).to_numpy(),
+    })
+    sums = rows.groupby(['FY', 'Ticker'])['Hash'].agg(['sum', 'size'])  # uint64 sums wrap, which is fine for a digest
+
+    digests = {}
+    for (year, ticker), total, size in zip(sums.index, sums['sum'], sums['size']):
+        digests.setdefault(int(year), {})[ticker] = f'{total:016x}-{size}'
+    return digests
+
+def match(txs_df, method='lifo', checkpoint_dir=CHECKPOINT_DIR, workers=None):
+    '''Matches sales to lots like `lots.match`, reusing checkpoints of tickers and years that have not changed and
+    saving checkpoints of the years it rematches
+
+    Args:
+        txs_df (pandas.DataFrame): Date indexed transactions with [Ticker, Volume, Price, PriceIncBrokerage], in date
+            order with buys on top for intra-day trades
+        method (str, optional): Cost basis method, one of `lots.METHODS` except 'specific'. Defaults to 'lifo'.
+        checkpoint_dir (Path, optional): Defaults to CHECKPOINT_DIR.
+        workers (int, optional): Processes to shard rematched tickers across, see `lots.match_parallel`
+
+    Returns:
+        tuple: (lots.AuditLog of every sale, open lots after the last transaction)
+    '''
+    if method == 'specific':
+        raise ValueError('Specific identification depends on row selections and cannot be checkpointed')
+
+    method_dir = checkpoint_dir / method
+    txs_df = txs_df[['Ticker', 'Volume', 'Price', 'PriceIncBrokerage']]
+    txs_df = txs_df.assign(Ticker=txs_df['Ticker'].astype(str))
+    digests = fy_digests(txs_df)
+    if not digests:
+        return _empty_audit(txs_df), txs_df
+
+    years = list(range(min(digests), max(digests) + 1))
+    saved = {
+        year: json.loads((method_dir / f'FY{year}.json').read_text())
+        for year in years if (method_dir / f'FY{year}.json').exists() and (method_dir / f'FY{year}_sales.npz').exists()
+    }
+
+    # Each ticker resumes after the last year whose checkpoint, and every one before it, saw the same transactions
+    tickers = {ticker for year_digests in list(digests.values()) + list(saved.values()) for ticker in year_digests}
+    resume = {}
+    for ticker in tickers:
+        resume[ticker] = years[0] - 1
+        for year in years:
+            if year not in saved or saved[year].get(ticker) != digests.get(year, {}).get(ticker):
+                break
+            resume[ticker] = year
+
+    start = min(resume.values()) + 1
+    fys = store.financial_year(txs_df.index)
+    audits = []
+    open_lots = _load(method_dir / f'FY{start - 1}_lots.npz', txs_df) if start - 1 in saved else txs_df.iloc[:0]
+
+    for year in years:
+        if year < start:
+            audits.append(_load_audit(method_dir, year))
+            continue
+
+        rematch = [ticker for ticker, resumed in resume.items() if resumed < year]
+        kept_audits, kept_lots = [], txs_df.iloc[:0]
+        if year in saved:
+            kept_audit = _load_audit(method_dir, year)
+            kept_audits = [kept_audit.select(~kept_audit.sales['Ticker'].isin(rematch))]
+            kept_lots = _load(method_dir / f'FY{year}_lots.npz', txs_df)
+            kept_lots = kept_lots[~kept_lots['Ticker'].isin(rematch)]
+
+        # Lots carried in from last year come first, so they keep their place in each ticker's order
+        fy_df = pd.concat([
+            open_lots[open_lots['Ticker'].isin(rematch)],
+            txs_df[(fys == year) & txs_df['Ticker'].isin(rematch).to_numpy()],
+        ])
+        index = portfolio.TickerIndex(fy_df)
+        matches = lots.match_parallel(
+            index.frame['Volume'].to_numpy(), index.offsets, index.tickers, method,
+            index.frame['PriceIncBrokerage'].to_numpy(), index.frame.index.to_numpy(), workers=workers,
+        )
+
+        fy_audit = lots.AuditLog.concat(kept_audits + [lots.AuditLog.from_matches(matches, index.frame)])
+        open_lots = pd.concat([kept_lots, lots.open_lot_table(matches, index.frame)])
+        _save(method_dir, year, fy_audit, open_lots, digests.get(year, {}))
+        audits.append(fy_audit)
+
+    if start <= years[-1]:  # Later checkpoints were built on the years just rematched
+        for json_path in method_dir.glob('FY*.json'):
+            if int(json_path.stem[2:]) > years[-1]:
+                json_path.unlink()
+    else:
+        open_lots = _load(method_dir / f'FY{years[-1]}_lots.npz', txs_df)
+
+    return lots.AuditLog.concat(audits), open_lots
+
+def _empty_audit(txs_df):
+    return lots.AuditLog.from_matches(lots.Matches([], [], [], [], []), txs_df.iloc[:0])
+
+def _save(method_dir, year, audit, lots_df, digests):
+    method_dir.mkdir(parents=True, exist_ok=True)
+    tables = [('sales', audit.sales), ('parcels', audit.parcels), ('links', audit.links), ('lots', lots_df.reset_index())]
+    for name, df in tables:
+        np.savez(method_dir / f'FY{year}_{name}.npz', **{
+            column: df[column].to_numpy(dtype=str) if df[column].dtype == object or df[column].dtype.name == 'category'
+            else df[column].to_numpy()
+            for column in df.columns
+        })
+    (method_dir / f'FY{year}.json').write_text(json.dumps(digests))  # Written last: marks the checkpoint complete
+
+def _load_audit(method_dir, year):
+    return lots.AuditLog(*[_load(method_dir / f'FY{year}_{name}.npz') for name in ['sales', 'parcels', 'links']])
+
+def _load(npz_path, txs_df=None):
+    # Audit tables load as saved. Lots load Date indexed with the columns and dtypes of `txs_df`
+    with np.load(npz_path) as arrays:
+        df = pd.DataFrame({column: arrays[column] for column in arrays.files})
+
+    if txs_df is None:
+        return df.astype({'Ticker': 'category'}) if 'Ticker' in df else df
+    df['Ticker'] = df['Ticker'].astype(object)
+    return df.set_index('Date').astype(txs_df.dtypes.to_dict())[list(txs_df.columns)]
@@ -0,0 +1,140 @@
+'''Daily holdings of every ticker as one dates x tickers matrix
+
+Signed trade volumes are pivoted into a (dates, tickers) array in one scatter, with a row per day from the first
+transaction, and cumulatively summed down the dates, so holdings over years of days and thousands of tickers
+take a handful of array operations. The matrix can be kept in a memory-mapped `.npy` file instead of memory:
+
+    holdings = Holdings.from_store(path=Path('reports/.holdings.npy'))
+    holdings.frame().loc['2021-06-30']
+'''
+import numpy as np
+import pandas as pd
+
+# Local imports
+from . import portfolio
+
+class Holdings():
+    '''Units of every ticker held at the end of each day
+
+    Attributes:
+        dates (pandas.DatetimeIndex): Rows, every day (or weekday) from the first transaction to `end`
+        tickers (list): Columns, in ticker order
+        volumes (numpy.ndarray): int64 (dates, tickers) units held, memory-mapped when built with a `path`
+    '''
+    def __init__(self, txs_df, end=None, weekdays=False, path=None):
+        '''
+        Args:
+            txs_df (pandas.DataFrame): Date indexed transactions with [Ticker, Volume], and Price to value holdings
+                at the last traded price
+            end (str or datetime, optional): Last day. Defaults to the last transaction.
+            weekdays (bool, optional): Only weekdays, trades on weekends count from the next weekday. Defaults
+                to False.
+            path (Path, optional): `.npy` file to memory-map the volumes to. Defaults to None, in memory.
+        '''
+        days = txs_df.index.to_numpy().astype('datetime64[D]')
+        if len(days):
+            last = days.max() if end is None else np.datetime64(pd.Timestamp(end), 'D')
+            calendar = pd.bdate_range if weekdays else pd.date_range
+            self.dates = calendar(days.min(), last, name='Date')
+        else:
+            self.dates = pd.DatetimeIndex([], name='Date')
+        self.tickers = [str(ticker) for ticker in pd.factorize(txs_df['Ticker'], sort=True)[1]]
+        cells, kept = self.cells(txs_df)
+
+        shape = (len(self.dates), len(self.tickers))
+        if path is None:
+            self.volumes = np.zeros(shape, dtype='int64')
+        else:
+            self.volumes = np.lib.format.open_memmap(path, mode='w+', dtype='int64', shape=shape)  # Zero filled
+
+        # Same day trades of a ticker share a cell, so they are summed before the scatter
+        unique_cells, inverse = np.unique(cells, return_inverse=True)
+        volumes = txs_df['Volume'].to_numpy(dtype='int64')[kept]
+        self.volumes.reshape(-1)[unique_cells] = np.bincount(inverse, weights=volumes).astype('int64')
+        np.cumsum(self.volumes, axis=0, out=self.volumes)
+
+        self.__trade_prices = None
+        if 'Price' in txs_df:
+            # Last trade of each cell, in transaction order
+            last_cells, last_rows = np.unique(cells[::-1], return_index=True)
+            self.__trade_prices = (last_cells, txs_df['Price'].to_numpy(dtype='float64')[kept][::-1][last_rows])
+
+    def cells(self, txs_df):
+        '''Flat (date, ticker) cell of each transaction, trades on days outside the calendar count from the next day
+        in it and trades after `end` are dropped
+
+        Returns:
+            tuple: (cell of each transaction kept, boolean mask of the transactions kept)
+        '''
+        codes, tickers = pd.factorize(txs_df['Ticker'])
+        columns = np.append(pd.Index(self.tickers).get_indexer([str(ticker) for ticker in tickers]), -1)[codes]
+        rows = np.searchsorted(self.dates.to_numpy().astype('datetime64[D]'), txs_df.index.to_numpy().astype('datetime64[D]'))
+        kept = (rows < len(self.dates)) & (columns >= 0)
+        return rows[kept] * len(self.tickers) + columns[kept], kept
+
+    def pivot(self, txs_df, values):
+        '''Sums a value per transaction into each (date, ticker) cell, e.g. cashflows
+
+        Returns:
+            numpy.ndarray: float64 (dates, tickers) array
+        '''
+        cells, kept = self.cells(txs_df)
+        values = np.asarray(values, dtype='float64')[kept]
+        return np.bincount(cells, weights=values, minlength=self.volumes.size).reshape(self.volumes.shape)
+
+    @classmethod
+    def from_store(cls, end=None, weekdays=False, path=None, data_dir=None):
+        '''Holdings from the transaction store, see `portfolio.transactions`'''
+        txs_df = portfolio.transactions(['Ticker', 'Volume', 'Price'], end=end, data_dir=data_dir)
+        return cls(txs_df, end=end, weekdays=weekdays, path=path)
+
+    def frame(self, values=None):
+        '''Returns:
+            pandas.DataFrame: `values` (defaults to the volumes) labelled with dates and tickers
+        '''
+        return pd.DataFrame(self.volumes if values is None else values, index=self.dates, columns=self.tickers)
+
+    def on(self, date):
+        '''Returns:
+            pandas.Series: Units of each ticker held at the end of `date`
+        '''
+        row = np.searchsorted(self.dates, pd.Timestamp(date), side='right') - 1
+        if row < 0:
+            return pd.Series(0, index=self.tickers, dtype='int64')
+        return pd.Series(self.volumes[row], index=self.tickers)
+
+    def trade_prices(self):
+        '''Returns:
+            numpy.ndarray: (dates, tickers) price of each ticker's last trade up to each day, NaN before the first
+        '''
+        if self.__trade_prices is None:
+            raise ValueError('Holdings were built without a Price column')
+
+        prices = np.full(self.volumes.shape, np.nan)
+        cells, cell_prices = self.__trade_prices
+        prices.reshape(-1)[cells] = cell_prices
+        return _ffill(prices)
+
+    def values(self, prices=None):
+        '''Market value of every holding on every day
+
+        Args:
+            prices (pandas.DataFrame, optional): Date indexed closing prices with a column per ticker, carried
+                forward over days without a price. Defaults to the last traded prices, see `trade_prices`.
+
+        Returns:
+            numpy.ndarray: (dates, tickers) values, 0 where nothing is held
+        '''
+        if prices is None:
+            prices = self.trade_prices()
+        else:
+            prices = prices.reindex(columns=self.tickers).sort_index()
+            prices = prices.reindex(self.dates.union(prices.index)).ffill().reindex(self.dates).to_numpy(dtype='float64')
+
+        return np.where(self.volumes != 0, self.volumes * prices, 0)
+
+def _ffill(array):
+    # Carries the last non-NaN value of each column down the rows
+    rows = np.where(np.isnan(array), 0, np.arange(len(array))[:, None])
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    return np.take_along_axis(array, rows, axis=0)
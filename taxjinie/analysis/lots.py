@@ -0,0 +1,734 @@
+'''Parcel (lot) matching engine for capital gains
+
+Transactions are passed as plain arrays grouped by ticker (see `portfolio.TickerIndex`), in date order with buys
+on top for intra-day trades. Buys open lots and every sell is matched against the open lots of its ticker,
+held in a `LotStore` ordered for the cost basis method: a stack (LIFO), a queue (FIFO), a price heap (HIFO),
+two price heaps split on discount eligibility (lowest taxable gain) or lots looked up by row (specific
+identification), and several methods can be matched in the same pass. Matches are recorded as a link table
+of columnar arrays, one row per (sell, lot) pair, gains are calculated for all links at once, and `AuditLog`
+keeps the links with the sales and parcels they refer to. `DiscountIndex` orders the lots left open by the date
+they become eligible for the CGT discount, and `SaleSimulator` prices what-if sales of them.
+'''
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import heapq
+import os
+import numpy as np
+import pandas as pd
+
+DISCOUNT_DAYS = 365  # Lots held for more than this many days get the CGT discount on gains
+PARALLEL_MIN_ROWS = 200_000  # Smaller tables match faster than a process pool starts
+SHARDS_PER_WORKER = 4
+
+class Matches():
+    '''Sell to lot links from one matching run. Row numbers are positions in the arrays passed to `match`
+
+    Attributes:
+        sell_rows, lot_rows, volumes (numpy.ndarray): One entry per (sell, lot) link, grouped by sell in
+            transaction order. `volumes` are the units of the lot used by the sell
+        open_rows, open_volumes (numpy.ndarray): Lots still open after the last transaction and their
+            remaining units
+    '''
+    __slots__ = ['sell_rows', 'lot_rows', 'volumes', 'open_rows', 'open_volumes']
+
+    def __init__(self, sell_rows, lot_rows, volumes, open_rows, open_volumes):
+        self.sell_rows = np.asarray(sell_rows, dtype='int64')
+        self.lot_rows = np.asarray(lot_rows, dtype='int64')
+        self.volumes = np.asarray(volumes, dtype='int64')
+        self.open_rows = np.asarray(open_rows, dtype='int64')
+        self.open_volumes = np.asarray(open_volumes, dtype='int64')
+
+class LotStore(ABC):
+    '''Open lots of one ticker, ordered by a cost basis method. Subclasses pick the next lot to sell from
+    '''
+    __slots__ = ()
+
+    @abstractmethod
+    def add(self, row, volume, price, day):
+        pass
+
+    @abstractmethod
+    def take(self, units, sell_row, price, day):
+        '''Sells up to `units` from the next lot. `price` and `day` are the sell's price and day number
+
+        Returns:
+            tuple: (lot row, units used)
+        '''
+
+    @abstractmethod
+    def open_lots(self):
+        '''Returns:
+            list: (lot row, remaining units) of each open lot, in row order
+        '''
+
+class LifoLots(LotStore):
+    '''Last in, first out: a stack of lots'''
+    __slots__ = ['rows', 'volumes']
+
+    def __init__(self):
+        self.rows, self.volumes = [], []
+
+    def __bool__(self):
+        return bool(self.rows)
+
+    def add(self, row, volume, price, day):
+        self.rows.append(row)
+        self.volumes.append(volume)
+
+    def take(self, units, sell_row, price, day):
+        row, volume = self.rows[-1], self.volumes[-1]
+        if units >= volume:  # Lot depleted
+            self.rows.pop()
+            self.volumes.pop()
+            return row, volume
+        self.volumes[-1] = volume - units
+        return row, units
+
+    def open_lots(self):
+        return list(zip(self.rows, self.volumes))
+
+class FifoLots(LotStore):
+    '''First in, first out: a queue of lots'''
+    __slots__ = ['rows', 'volumes']
+
+    def __init__(self):
+        self.rows, self.volumes = deque(), deque()
+
+    def __bool__(self):
+        return bool(self.rows)
+
+    def add(self, row, volume, price, day):
+        self.rows.append(row)
+        self.volumes.append(volume)
+
+    def take(self, units, sell_row, price, day):
+        row, volume = self.rows[0], self.volumes[0]
+        if units >= volume:
+            self.rows.popleft()
+            self.volumes.popleft()
+            return row, volume
+        self.volumes[0] = volume - units
+        return row, units
+
+    def open_lots(self):
+        return list(zip(self.rows, self.volumes))
+
+class HifoLots(LotStore):
+    '''Highest cost first: a heap of lots keyed on price, most recent first for equal prices'''
+    __slots__ = ['heap']
+
+    def __init__(self):
+        self.heap = []  # [-price, -row, volume]
+
+    def __bool__(self):
+        return bool(self.heap)
+
+    def add(self, row, volume, price, day):
+        heapq.heappush(self.heap, [-price, -row, volume])
+
+    def take(self, units, sell_row, price, day):
+        lot = self.heap[0]
+        if units >= lot[2]:
+            heapq.heappop(self.heap)
+            return -lot[1], lot[2]
+        lot[2] -= units  # Volume is not part of the heap order
+        return -lot[1], units
+
+    def open_lots(self):
+        return sorted((-lot[1], lot[2]) for lot in self.heap)
+
+class MinTaxLots(LotStore):
+    '''Lowest taxable gain first: each unit sold comes from the lot with the lowest taxable gain per unit at the
+    sale, after the CGT discount. Within the discount eligible lots and within the rest, that is the highest cost
+    lot, so both groups are price heaps. Lots wait in date order and move to the eligible heap once held for more
+    than DISCOUNT_DAYS. Minimises tax sale by sale, not over the whole history
+    '''
+    __slots__ = ['volumes', 'eligible', 'recent', 'waiting', 'matured']
+
+    def __init__(self):
+        self.volumes = {}       # {lot row: remaining units}
+        self.eligible = []      # Heap of (-price, -row), discount eligible
+        self.recent = []        # Heap of (-price, -row), may hold lots since moved to `eligible`
+        self.waiting = deque()  # (day, price, row) of lots in `recent`, in date order
+        self.matured = set()    # Rows moved to `eligible`
+
+    def __bool__(self):
+        return bool(self.volumes)
+
+    def add(self, row, volume, price, day):
+        self.volumes[row] = volume
+        heapq.heappush(self.recent, (-price, -row))
+        self.waiting.append((day, price, row))
+
+    def take(self, units, sell_row, price, day):
+        while self.waiting and day - self.waiting[0][0] > DISCOUNT_DAYS:
+            _, lot_price, row = self.waiting.popleft()
+            if row in self.volumes:
+                heapq.heappush(self.eligible, (-lot_price, -row))
+                self.matured.add(row)
+
+        # Drop closed and moved lots from the heap tops
+        while self.recent and (-self.recent[0][1] not in self.volumes or -self.recent[0][1] in self.matured):
+            heapq.heappop(self.recent)
+        while self.eligible and -self.eligible[0][1] not in self.volumes:
+            heapq.heappop(self.eligible)
+
+        heap = self.recent
+        if self.eligible:
+            gain = price + self.eligible[0][0]
+            eligible_taxable = gain / 2 if gain > 0 else gain
+            if not self.recent or eligible_taxable <= price + self.recent[0][0]:
+                heap = self.eligible
+
+        row = -heap[0][1]
+        volume = self.volumes[row]
+        if units >= volume:
+            heapq.heappop(heap)
+            del self.volumes[row]
+            self.matured.discard(row)
+            return row, volume
+        self.volumes[row] = volume - units
+        return row, units
+
+    def open_lots(self):
+        return sorted(self.volumes.items())
+
+class SpecificLots(LotStore):
+    '''Specific identification: each sell uses the lots selected for it, in order. Units not covered by a
+    selection fall back to last in, first out
+
+    Args:
+        selections (dict): {sell row: [lot row, ...]}, shared by the stores of every ticker and not modified
+    '''
+    __slots__ = ['volumes', 'selections', 'picks']
+
+    def __init__(self, selections):
+        self.volumes = {}  # {lot row: remaining units}, in row order
+        self.selections = selections
+        self.picks = {}  # {sell row: selected lots not used up yet}, only for this ticker's sells
+
+    def __bool__(self):
+        return bool(self.volumes)
+
+    def add(self, row, volume, price, day):
+        self.volumes[row] = volume
+
+    def take(self, units, sell_row, price, day):
+        picks = self.picks.get(sell_row)
+        if picks is None and sell_row in self.selections:
+            picks = self.picks[sell_row] = deque(self.selections[sell_row])
+        if picks:
+            row = picks[0]
+            if row not in self.volumes:
+                raise ValueError(f'Lot at row {row} selected for the sell at row {sell_row} is not open')
+        else:
+            row = next(reversed(self.volumes))
+
+        volume = self.volumes[row]
+        if units >= volume:
+            del self.volumes[row]
+            if picks:
+                picks.popleft()
+            return row, volume
+        self.volumes[row] = volume - units
+        return row, units
+
+    def open_lots(self):
+        return sorted(self.volumes.items())
+
+METHODS = {'lifo': LifoLots, 'fifo': FifoLots, 'hifo': HifoLots, 'mintax': MinTaxLots, 'specific': SpecificLots}
+
+def lot_store(method, selections=None):
+    '''Returns:
+        LotStore: Empty store for a cost basis method, one of `METHODS`
+    '''
+    if method not in METHODS:
+        raise ValueError(f'Invalid cost basis method. Expected one of: {list(METHODS)}')
+    return SpecificLots(selections or {}) if method == 'specific' else METHODS[method]()
+
+def match(volumes, offsets, tickers=None, method='lifo', prices=None, dates=None, selections=None):
+    '''Matches every sell against open lots using one cost basis method
+
+    Args:
+        volumes (numpy.ndarray): Signed volumes, positive for buys. Rows with a volume of 0 or less are sells
+        offsets (numpy.ndarray): Row ranges of each ticker, ticker i is rows offsets[i]:offsets[i + 1]
+        tickers (list, optional): Ticker names, used in error messages
+        method (str, optional): One of `METHODS`. Defaults to 'lifo'.
+        prices (numpy.ndarray, optional): Prices including brokerage, required for 'hifo' and 'mintax'
+        dates (numpy.ndarray, optional): datetime64 transaction dates, required for 'mintax'
+        selections (dict, optional): {sell row: [lot row, ...]} for 'specific'
+
+    Raises:
+        ValueError: When a sell has more units than the open lots of its ticker
+
+    Returns:
+        Matches: Link table and the lots left open
+    '''
+    return match_methods(volumes, offsets, tickers, [method], prices, dates, selections)[method]
+
+def match_parallel(volumes, offsets, tickers=None, method='lifo', prices=None, dates=None, selections=None, workers=None):
+    '''`match` with tickers sharded across a process pool. Each shard is a contiguous range of tickers with about
+    the same number of rows, sent as array slices, and the shards' links are gathered into one `Matches`
+
+    Args:
+        workers (int, optional): Processes to use. Defaults to the CPU count. Small tables are matched in this
+            process, see PARALLEL_MIN_ROWS.
+    '''
+    workers = workers or os.cpu_count()
+    if workers <= 1 or len(volumes) < PARALLEL_MIN_ROWS:
+        return match(volumes, offsets, tickers, method, prices, dates, selections)
+
+    # Ticker boundaries nearest to equal row counts, a few shards per worker to even out uneven tickers
+    cuts = np.searchsorted(offsets, np.linspace(0, offsets[-1], workers * SHARDS_PER_WORKER + 1), side='right') - 1
+    cuts = np.unique(np.clip(cuts, 0, len(offsets) - 1))
+    cuts[0], cuts[-1] = 0, len(offsets) - 1
+
+    shards = []
+    for first, last in zip(cuts[:-1], cuts[1:]):
+        lo, hi = offsets[first], offsets[last]
+        shards.append((
+            volumes[lo:hi], offsets[first:last + 1] - lo, None if tickers is None else tickers[first:last], method,
+            None if prices is None else prices[lo:hi], None if dates is None else dates[lo:hi],
+            {row - lo: [lot - lo for lot in lot_rows] for row, lot_rows in (selections or {}).items() if lo <= row < hi},
+        ))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(_match_shard, shards))
+
+    # Shift shard rows back to rows of the whole table
+    starts = offsets[cuts[:-1]]
+    sell_rows, lot_rows, link_volumes, open_rows, open_volumes = zip(*results)
+    return Matches(
+        np.concatenate([rows + start for rows, start in zip(sell_rows, starts)]),
+        np.concatenate([rows + start for rows, start in zip(lot_rows, starts)]),
+        np.concatenate(link_volumes),
+        np.concatenate([rows + start for rows, start in zip(open_rows, starts)]),
+        np.concatenate(open_volumes),
+    )
+
+def _match_shard(shard):
+    matches = match(*shard)
+    return matches.sell_rows, matches.lot_rows, matches.volumes, matches.open_rows, matches.open_volumes
+
+def match_methods(volumes, offsets, tickers=None, methods=('lifo',), prices=None, dates=None, selections=None):
+    '''Runs several cost basis methods side by side in one pass over the transactions. See `match`
+
+    Returns:
+        dict: {method: Matches}
+    '''
+    if {'hifo', 'mintax'} & set(methods) and prices is None:
+        raise ValueError('Prices are required to match lots by cost')
+    if 'mintax' in methods and dates is None:
+        raise ValueError('Dates are required to match lots by taxable gain')
+
+    volumes = volumes.tolist()  # Python ints are much faster than numpy scalars in the loop below
+    prices = [0.0] * len(volumes) if prices is None else prices.tolist()
+    days = [0] * len(volumes) if dates is None else dates.astype('datetime64[D]').astype('int64').tolist()
+    links = {method: ([], [], []) for method in methods}
+    open_lots = {method: [] for method in methods}
+
+    for i in range(len(offsets) - 1):
+        stores = [(method, lot_store(method, selections), links[method]) for method in methods]
+
+        for row in range(offsets[i], offsets[i + 1]):
+            volume = volumes[row]
+            if volume > 0:
+                for _, store, _ in stores:
+                    store.add(row, volume, prices[row], days[row])
+                continue
+
+            for _, store, (sell_rows, lot_rows, link_volumes) in stores:
+                remaining = -volume
+                while remaining > 0:
+                    if not store:
+                        ticker = tickers[i] if tickers is not None else i
+                        raise ValueError(f'There is a missing buy transaction for {ticker}, with volume: {remaining}')
+
+                    lot_row, used = store.take(remaining, row, prices[row], days[row])
+                    sell_rows.append(row)
+                    lot_rows.append(lot_row)
+                    link_volumes.append(used)
+                    remaining -= used
+
+        for method, store, _ in stores:
+            open_lots[method].extend(store.open_lots())
+
+    return {
+        method: Matches(*links[method], *(zip(*open_lots[method]) if open_lots[method] else ([], [])))
+        for method in methods
+    }
+
+def link_gains(matches, dates, prices):
+    '''Capital gains of every link. Prices include brokerage, which is deductible
+
+    Args:
+        matches (Matches): Output of `match`
+        dates (numpy.ndarray): datetime64 transaction dates
+        prices (numpy.ndarray): Prices including brokerage
+
+    Returns:
+        dict: Arrays per link: [Cost, Proceeds, Capital Gains, Discounted, Capital Gains Taxable]
+    '''
+    days = dates.astype('datetime64[D]').astype('int64')
+    cost = matches.volumes * prices[matches.lot_rows]
+    proceeds = matches.volumes * prices[matches.sell_rows]
+    gains = proceeds - cost
+    discounted = ((days[matches.sell_rows] - days[matches.lot_rows]) > DISCOUNT_DAYS) & (gains > 0)
+
+    return {
+        'Cost': cost,
+        'Proceeds': proceeds,
+        'Capital Gains': gains,
+        'Discounted': discounted,
+        'Capital Gains Taxable': np.where(discounted, gains / 2, gains),  # Apply any capital gains discounts
+    }
+
+class AuditLog():
+    '''Columnar audit trail of matched sales: a flat sale to lot link table, plus the sales and buy parcels it
+    refers to by id. Nested per sale views are only built on request, see `nested`
+
+    Attributes:
+        sales (pandas.DataFrame): One row per sale, row position is the sale id: [Date, Ticker, Volume, Price,
+            PriceIncBrokerage, Capital Gains, Capital Gains Taxable, Parcels]
+        parcels (pandas.DataFrame): One row per buy parcel used, row position is the lot id: [Date, Ticker, Price,
+            PriceIncBrokerage]
+        links (pandas.DataFrame): One row per (sale, lot) link, in sale order: [Sale, Lot, Volume, Cost, Proceeds,
+            Capital Gains, Discounted, Capital Gains Taxable]
+    '''
+    __slots__ = ['sales', 'parcels', 'links']
+
+    def __init__(self, sales, parcels, links):
+        self.sales, self.parcels, self.links = sales, parcels, links
+
+    def __len__(self):
+        return len(self.sales)
+
+    @classmethod
+    def from_matches(cls, matches, frame):
+        '''
+        Args:
+            matches (Matches): Output of `match` over the rows of `frame`
+            frame (pandas.DataFrame): Date indexed transactions with [Ticker, Volume, Price, PriceIncBrokerage]
+        '''
+        sell_rows, sale_ids = np.unique(matches.sell_rows, return_inverse=True)  # Links are in sell row order
+        lot_rows, lot_ids = np.unique(matches.lot_rows, return_inverse=True)
+        gains = link_gains(matches, frame.index.to_numpy(), frame['PriceIncBrokerage'].to_numpy())
+
+        sales = _trades(frame, sell_rows, ['Ticker', 'Volume', 'Price', 'PriceIncBrokerage'])
+        for column in ['Capital Gains', 'Capital Gains Taxable']:
+            sales[column] = np.bincount(sale_ids, weights=gains[column], minlength=len(sell_rows))
+        sales['Parcels'] = np.bincount(sale_ids, minlength=len(sell_rows))
+
+        links = pd.DataFrame({'Sale': sale_ids, 'Lot': lot_ids, 'Volume': matches.volumes, **gains})
+        return cls(sales, _trades(frame, lot_rows, ['Ticker', 'Price', 'PriceIncBrokerage']), links)
+
+    @classmethod
+    def concat(cls, logs):
+        '''Joins audit logs, renumbering sale and lot ids'''
+        sale_offsets = np.cumsum([0] + [len(log.sales) for log in logs])
+        lot_offsets = np.cumsum([0] + [len(log.parcels) for log in logs])
+        links = [
+            log.links.assign(Sale=log.links['Sale'] + sale_offset, Lot=log.links['Lot'] + lot_offset)
+            for log, sale_offset, lot_offset in zip(logs, sale_offsets, lot_offsets)
+        ]
+        return cls(
+            _categorical(pd.concat([log.sales for log in logs], ignore_index=True)),
+            _categorical(pd.concat([log.parcels for log in logs], ignore_index=True)),
+            pd.concat(links, ignore_index=True),
+        )
+
+    def select(self, sale_mask):
+        '''Returns:
+            AuditLog: The sales in `sale_mask` (a boolean per sale) with their links and parcels, renumbered
+        '''
+        sale_mask = np.asarray(sale_mask, dtype=bool)
+        links = self.links[sale_mask[self.links['Sale'].to_numpy()]]
+        lot_rows, lot_ids = np.unique(links['Lot'].to_numpy(), return_inverse=True)
+        sale_ids = np.cumsum(sale_mask) - 1
+
+        return AuditLog(
+            self.sales[sale_mask].reset_index(drop=True),
+            self.parcels.iloc[lot_rows].reset_index(drop=True),
+            links.assign(Sale=sale_ids[links['Sale'].to_numpy()], Lot=lot_ids).reset_index(drop=True),
+        )
+
+    def split(self, sale_groups):
+        '''Splits the log by a label per sale, e.g. the portfolio of each sale, renumbering ids within each part
+
+        Returns:
+            dict: {label: AuditLog}
+        '''
+        sale_groups = np.asarray(sale_groups, dtype=object)
+        link_groups = sale_groups[self.links['Sale'].to_numpy()]
+        lot_groups = np.empty(len(self.parcels), dtype=object)
+        lot_groups[self.links['Lot'].to_numpy()] = link_groups  # Parcels are only used by sales of one label
+
+        sale_ids = pd.Series(sale_groups).groupby(sale_groups, sort=False).cumcount().to_numpy()
+        lot_ids = pd.Series(lot_groups).groupby(lot_groups, sort=False).cumcount().to_numpy()
+        links = self.links.assign(Sale=sale_ids[self.links['Sale'].to_numpy()], Lot=lot_ids[self.links['Lot'].to_numpy()])
+
+        sales_by = self.sales.groupby(sale_groups, sort=False)
+        parcels_by = self.parcels.groupby(lot_groups, sort=False)
+        links_by = links.groupby(link_groups, sort=False)
+        return {
+            label: AuditLog(
+                _categorical(sales_by.get_group(label).reset_index(drop=True)),
+                _categorical(parcels_by.get_group(label).reset_index(drop=True)),
+                links_by.get_group(label).reset_index(drop=True),
+            )
+            for label in sales_by.groups
+        }
+
+    def link_frame(self):
+        '''Returns:
+            pandas.DataFrame: One flat row per link, with its sale's ticker and date and its parcel's date and prices
+        '''
+        sales = self.links['Sale'].to_numpy()
+        lots = self.links['Lot'].to_numpy()
+        return pd.DataFrame({
+            'Sale': sales,
+            'Ticker': self.sales['Ticker'].to_numpy()[sales],
+            'Date': self.sales['Date'].to_numpy()[sales],
+            'Buy Date': self.parcels['Date'].to_numpy()[lots],
+            'Buy Price': self.parcels['Price'].to_numpy()[lots],
+            'Buy PriceIncBrokerage': self.parcels['PriceIncBrokerage'].to_numpy()[lots],
+            **{column: self.links[column].to_numpy() for column in self.links.columns[2:]},
+        })
+
+    def nested(self, sales=None):
+        '''Materialises per sale dicts of the sale, its buy parcels and the units used from each
+
+        Args:
+            sales (list, optional): Sale ids. Defaults to every sale.
+
+        Returns:
+            list: Dicts of [Ticker, Date, Volume, Capital Gains, Capital Gains Taxable, Buy Parcels, Sell Parcel]
+        '''
+        sales = range(len(self.sales)) if sales is None else sales
+        bounds = np.searchsorted(self.links['Sale'].to_numpy(), np.arange(len(self.sales) + 1))
+        lots, volumes = self.links['Lot'].to_numpy(), self.links['Volume'].to_numpy()
+
+        nested = []
+        for sale in sales:
+            sale_row = self.sales.iloc[sale]
+            nested.append({
+                'Ticker': sale_row['Ticker'],
+                'Date': sale_row['Date'],
+                'Volume': sale_row['Volume'],
+                'Capital Gains': sale_row['Capital Gains'],
+                'Capital Gains Taxable': sale_row['Capital Gains Taxable'],
+                'Buy Parcels': [
+                    _parcel(self.parcels.iloc[lots[i]], volumes[i]) for i in range(bounds[sale], bounds[sale + 1])
+                ],
+                'Sell Parcel': _parcel(sale_row, sale_row['Volume']),
+            })
+        return nested
+
+def _trades(frame, rows, columns):
+    return _categorical(frame.iloc[rows][columns].rename_axis('Date').reset_index())
+
+def _categorical(df):
+    return df.astype({'Ticker': 'category'})  # One copy of each ticker name, however many rows
+
+def _parcel(row, volume):
+    return {
+        'Ticker': row['Ticker'],
+        'Date': row['Date'],
+        'Volume': volume,
+        'Price': row['Price'],
+        'PriceIncBrokerage': row['PriceIncBrokerage'],
+        'Brokerage': np.abs(volume * (row['PriceIncBrokerage'] - row['Price'])),
+    }
+
+def open_lot_table(matches, frame):
+    '''Returns:
+        pandas.DataFrame: Open lots as Date indexed buys of their remaining units, with the columns of `frame`
+    '''
+    return frame.iloc[matches.open_rows].assign(Volume=matches.open_volumes)
+
+class DiscountIndex():
+    '''Open lots sorted by the date they become eligible for the CGT discount, so date window queries across all
+    tickers are a binary search
+
+    Attributes:
+        lots (pandas.DataFrame): Open lots in discount date order: [Date, Ticker, Volume, Price, PriceIncBrokerage,
+            Discount Date]
+        dates (numpy.ndarray): datetime64[D] discount date of each lot
+        as_of (numpy.datetime64): Day the lots are open at, or None when unknown
+    '''
+    __slots__ = ['lots', 'dates', 'as_of']
+
+    def __init__(self, open_lots, as_of=None):
+        '''
+        Args:
+            open_lots (pandas.DataFrame): Date indexed open lots, see `open_lot_table`
+            as_of (str or datetime, optional): Day the lots are open at. Queries for earlier days are rejected, as
+                lots bought since were not held then and lots sold since are missing. Defaults to None.
+        '''
+        self.as_of = None if as_of is None else _day(as_of)
+        # A sale gets the discount when it is more than DISCOUNT_DAYS after the buy
+        dates = open_lots.index.to_numpy().astype('datetime64[D]') + np.timedelta64(DISCOUNT_DAYS + 1, 'D')
+        order = np.argsort(dates, kind='stable')
+        self.dates = dates[order]
+        self.lots = open_lots.iloc[order].rename_axis('Date').reset_index()
+        self.lots['Discount Date'] = self.dates.astype('datetime64[ns]')
+
+    def __len__(self):
+        return len(self.dates)
+
+    def between(self, start, end):
+        '''Returns:
+            pandas.DataFrame: Lots becoming eligible from `start` to `end`, inclusive
+        '''
+        lo = np.searchsorted(self.dates, _day(start), side='left')
+        hi = np.searchsorted(self.dates, _day(end), side='right')
+        return self.lots.iloc[lo:hi]
+
+    def upcoming(self, days, as_of):
+        '''Returns:
+            pandas.DataFrame: Lots not yet eligible on `as_of` that become eligible within the following `days`
+        '''
+        self.__check_day(as_of)
+        return self.between(_day(as_of) + np.timedelta64(1, 'D'), _day(as_of) + np.timedelta64(days, 'D'))
+
+    def eligible(self, as_of):
+        '''Returns:
+            pandas.DataFrame: Lots eligible for the discount if sold on `as_of`
+        '''
+        self.__check_day(as_of)
+        return self.lots.iloc[:np.searchsorted(self.dates, _day(as_of), side='right')]
+
+    def __check_day(self, as_of):
+        if self.as_of is not None and _day(as_of) < self.as_of:
+            raise ValueError(f'Lots are open as of {self.as_of}, index the lots open on {_day(as_of)} instead')
+
+class SaleSimulator():
+    '''What-if sales against the open lots under each cost basis method, without adding trades and rematching
+    the history. Every simulated sale starts from the same open lots
+
+    Lots are grouped by ticker in date order. The LIFO, FIFO and HIFO orders do not depend on the sale price, so
+    they are sorted once with the units held before each lot. The lowest taxable gain order does, so it is
+    sorted per batch of queries.
+
+    Args:
+        open_lots (pandas.DataFrame): Date indexed open lots, see `open_lot_table`
+        as_of (str or datetime): Day of the simulated sales, which decides discount eligibility
+    '''
+    __slots__ = ['as_of', 'codes', 'offsets', 'held', 'volumes', 'costs', 'eligible', 'orders', 'before']
+
+    def __init__(self, open_lots, as_of):
+        self.as_of = _day(as_of)
+        tickers = open_lots['Ticker'].astype(str).to_numpy()
+        days = open_lots.index.to_numpy().astype('datetime64[D]')
+        order = np.lexsort((days, tickers))
+        tickers, days = tickers[order], days[order]
+        self.volumes = open_lots['Volume'].to_numpy(dtype='int64')[order]
+        self.costs = open_lots['PriceIncBrokerage'].to_numpy(dtype='float64')[order]
+        self.eligible = (self.as_of - days).astype('int64') > DISCOUNT_DAYS
+
+        names, starts = np.unique(tickers, return_index=True)
+        self.codes = {name: code for code, name in enumerate(names)}
+        self.offsets = np.append(starts, len(tickers)).astype('int64')
+        held = np.concatenate([[0], np.cumsum(self.volumes)])
+        self.held = held[self.offsets[1:]] - held[self.offsets[:-1]]
+
+        # Lot positions in the order each method sells them, and the units of the ticker sold before each
+        group = np.repeat(np.arange(len(names)), np.diff(self.offsets))
+        position = np.arange(len(tickers))
+        self.orders = {
+            'lifo': np.lexsort((-position, group)),
+            'fifo': position,
+            'hifo': np.lexsort((-position, -self.costs, group)),
+            # Lowest taxable gain ties go to eligible lots, then the highest cost, then the most recent
+            'mintax ties': np.lexsort((-position, -self.costs, ~self.eligible, group)),
+        }
+        self.before = {}
+        for method in ['lifo', 'fifo', 'hifo']:
+            method_order = self.orders[method]
+            before = np.cumsum(self.volumes[method_order]) - self.volumes[method_order]
+            self.before[method] = before - np.repeat(before[self.offsets[:-1]], np.diff(self.offsets))
+
+    def simulate(self, tickers, units, prices, method='lifo'):
+        '''Capital gains of selling `units` of each ticker at each of its prices
+
+        Args:
+            tickers (list): Tickers to sell, or one ticker
+            units (int or numpy.ndarray): Units sold per ticker
+            prices (float or numpy.ndarray): Sale prices net of brokerage: one price, a row of prices for every
+                ticker, or one row per ticker
+            method (str, optional): 'lifo', 'fifo', 'hifo' or 'mintax'. Defaults to 'lifo'.
+
+        Raises:
+            ValueError: When selling more units than are held
+
+        Returns:
+            dict: Arrays of shape (tickers, prices): [Cost, Proceeds, Capital Gains, Capital Gains Taxable]
+        '''
+        tickers = [tickers] if isinstance(tickers, str) else list(tickers)
+        codes = np.array([self.codes.get(ticker, -1) for ticker in tickers], dtype='int64')
+        units = np.broadcast_to(np.asarray(units, dtype='int64'), codes.shape)
+        prices = np.atleast_1d(np.asarray(prices, dtype='float64'))
+        prices = np.broadcast_to(prices[None, :] if prices.ndim == 1 else prices, (len(codes), prices.shape[-1]))
+
+        known = codes >= 0
+        held = np.where(known, self.held[codes], 0)
+        short = np.flatnonzero(units > held)
+        if len(short):
+            i = short[0]
+            raise ValueError(f'Cannot sell {units[i]} units of {tickers[i]}, {held[i]} are held')
+
+        # One entry per open lot of each queried ticker
+        lo = np.where(known, self.offsets[codes], 0)
+        counts = np.where(known, self.offsets[codes + 1] - lo, 0)
+        query = np.repeat(np.arange(len(codes)), counts)
+        positions = np.arange(counts.sum()) + np.repeat(lo - (np.cumsum(counts) - counts), counts)
+
+        if method == 'mintax':
+            lots = self.orders['mintax ties'][positions]
+            used = self.__mintax_units(query, lots, counts, units, prices)
+        elif method in self.before:
+            lots = self.orders[method][positions]
+            used = np.clip(units[query] - self.before[method][positions], 0, self.volumes[lots])[:, None]
+        else:
+            raise ValueError(f'Cannot simulate sales with the {method} method')
+
+        cost = used * self.costs[lots][:, None]
+        gains = used * prices[query] - cost
+        taxable = np.where(self.eligible[lots][:, None] & (gains > 0), gains / 2, gains)
+
+        shape = prices.shape
+        return {
+            'Cost': np.broadcast_to(_query_sums(cost, counts), shape),
+            'Proceeds': units[:, None] * prices,
+            'Capital Gains': np.broadcast_to(_query_sums(gains, counts), shape),
+            'Capital Gains Taxable': np.broadcast_to(_query_sums(taxable, counts), shape),
+        }
+
+    def __mintax_units(self, query, lots, counts, units, prices):
+        # Units used from each lot per price, selling the lowest taxable gain per unit first as `MinTaxLots` does.
+        # Each query's lots are padded to a row per price and sorted along the row. `lots` are in tie order, so a
+        # stable sort on the taxable gain settles ties like the heaps
+        slot = np.arange(len(lots)) - np.repeat(np.cumsum(counts) - counts, counts)
+        gains = prices[query] - self.costs[lots][:, None]
+        taxable = np.full((len(counts), prices.shape[1], counts.max(initial=0)), np.inf)
+        taxable[query, :, slot] = np.where(self.eligible[lots][:, None] & (gains > 0), gains / 2, gains)
+        volumes = np.zeros(taxable.shape, dtype='int64')
+        volumes[query, :, slot] = self.volumes[lots][:, None]
+
+        order = np.argsort(taxable, axis=2, kind='stable')
+        volumes = np.take_along_axis(volumes, order, axis=2)
+        used = np.empty(volumes.shape, dtype='int64')
+        np.put_along_axis(used, order, np.clip(units[:, None, None] - (np.cumsum(volumes, axis=2) - volumes), 0, volumes), axis=2)
+        return used[query, :, slot]
+
+def _query_sums(values, counts):
+    # Sums rows of `values` over consecutive groups of `counts` rows, which may be empty
+    sums = np.zeros((len(counts), values.shape[1]))
+    nonempty = counts > 0
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(values, (np.cumsum(counts) - counts)[nonempty], axis=0)
+    return sums
+
+def _day(date):
+    return np.datetime64(pd.Timestamp(date), 'D')
@@ -1,47 +1,60 @@
-import pandas as pd
 from pathlib import Path
 
 # Local imports
 from . import portfolio
 
+CASHFLOW_COLUMNS = ['Volume', 'Cashflow', 'CashflowIncBrokerage']
+FREQUENCIES = {'W': 'W', 'M': 'M', 'Q': 'Q', 'FY': 'A-JUN'}  # Period aliases, financial years end in June
+FREQUENCY_NAMES = {'W': 'weekly', 'M': 'monthly', 'Q': 'quarterly', 'FY': 'fy'}
+REPORTS_DIR = Path(__file__).parent.parent / 'reports'
+
 class Performance():
-  def __init__(self) -> None:
-    self.txs = portfolio.transactions()
+  def __init__(self, data_dir=None, reports_dir=REPORTS_DIR) -> None:
+    '''
+    Args:
+      data_dir (Path, optional): Portfolio data folder, see `portfolio.transactions`. Defaults to portfolio.DATA_DIR.
+      reports_dir (Path, optional): Folder reports are saved to. Defaults to REPORTS_DIR.
+    '''
+    self.reports_dir = Path(reports_dir)
+    self.txs = portfolio.transactions(data_dir=data_dir)
     self.calculate_tx_cashflows()
+    self.tickers = portfolio.TickerIndex(self.txs)
   
   def calculate_tx_cashflows(self):
     # Group transactions into months
     self.txs['CashflowIncBrokerage'] = self.txs['Volume'] * self.txs['PriceIncBrokerage']
     self.txs['Cashflow'] = self.txs['Volume'] * self.txs['Price']
   
-  def _ticker_monthly_cashflows(self, ticker):
-    ticker_df = self.txs[self.txs['Ticker'] == ticker]
-    ticker_df = ticker_df.groupby(pd.Grouper(freq='M')).sum()
-    ticker_df = ticker_df.set_index(ticker_df.index.values.astype('datetime64[M]'))
-    
-    ticker_df['Ticker'] = ticker
-    ticker_series = ticker_df['Ticker']
-    ticker_df = ticker_df.drop(columns=['Ticker'])
-    ticker_df.insert(loc=0, column='Ticker', value=ticker_series)
-    
-    return ticker_df[ticker_df['Volume'] != 0]
-
-  def monthly_cashflows(self, ticker:str='portfolio', export=False):
-    ticker_df = pd.DataFrame()
-
-    if ticker == 'portfolio':
-      for looped_ticker in self.txs['Ticker'].unique():
-        ticker_df = pd.concat([ticker_df, self._ticker_monthly_cashflows(looped_ticker)])
-
-    else:
-      ticker_df = pd.concat([ticker_df, self._ticker_monthly_cashflows(ticker)])
+  def cashflows(self, freq='M', ticker='portfolio', export=False):
+    '''Cashflows of each ticker per period, from one grouped pass over the transactions however many tickers
+    there are
+
+    Args:
+      freq (str, optional): 'W', 'M', 'Q', 'FY' (ending June) or another pandas period alias. Defaults to 'M'.
+      ticker (str, optional): One ticker, or 'portfolio' for all of them. Defaults to 'portfolio'.
+      export (bool, optional): Also save the cashflows to `reports_dir`. Defaults to False.
+
+    Returns:
+      pandas.DataFrame: Indexed by the start of each period, [Ticker, Volume, Cashflow, CashflowIncBrokerage] for
+        every ticker and period with transactions, by ticker then date
+    '''
+    txs_df = self.txs if ticker == 'portfolio' else self.tickers[ticker]
+    periods = txs_df.index.to_period(FREQUENCIES.get(freq, freq))
+
+    cashflows_df = txs_df.groupby([txs_df['Ticker'], periods], observed=True)[CASHFLOW_COLUMNS].sum().sort_index()
+    cashflows_df = cashflows_df.reset_index(level='Ticker')
+    cashflows_df.index = cashflows_df.index.start_time.rename('Date')
+    cashflows_df['Ticker'] = cashflows_df['Ticker'].astype(object)
 
     if export:
-      last_month = ticker_df.last_valid_index()
-      fname = f'monthly_cashflows_{last_month:%Y%m%d}'
-      fpath = Path(__file__).parent.parent / 'reports' / fname
-      ticker_df.to_excel(fpath.with_suffix('.xlsx'))
+      fname = f'{FREQUENCY_NAMES.get(freq, freq)}_cashflows_{cashflows_df.index.max():%Y%m%d}'
+      self.reports_dir.mkdir(parents=True, exist_ok=True)
+      fpath = self.reports_dir / fname
+      cashflows_df.to_excel(fpath.with_suffix('.xlsx'))
 
       print(f'Saved!\n\tFilename:\t{fpath.name}\n\tOutput path:\t{fpath}')
 
-    return ticker_df
+    return cashflows_df
+
+  def monthly_cashflows(self, ticker:str='portfolio', export=False):
+    return self.cashflows('M', ticker, export)
@@ -1,40 +1,161 @@
 from pathlib import Path
+import hashlib
 import pandas as pd
 import numpy as np
 
+# Local imports
+from transactions import store
+
 DATA_DIR = Path(__file__).parent.parent / 'transactions'
 
-def transactions():
-    pickles = sorted(list(DATA_DIR.glob('*.pkl')))
-    
+_cache = {}  # {data folder: {'signature': ..., 'frames': {...}}}, tables shared by every analysis in this process
+
+def transactions(columns=None, start=None, end=None, data_dir=None):
+    '''Loads the master transaction table. Tables are cached for the process until the store changes, and every
+    call gets its own read-only view: new columns can be added, but existing values cannot be written to
+
+    Args:
+        columns (list, optional): Columns to load, Date is always the index. Defaults to all columns.
+        start (str or datetime, optional): First date to include. Defaults to None.
+        end (str or datetime, optional): Last date to include. Defaults to None.
+        data_dir (Path, optional): Portfolio data folder, as built by `tx_loader.Loader`. Defaults to DATA_DIR.
+
+    Returns:
+        pandas.DataFrame: Transactions in date order, buys on top for intra-day trades
+    '''
+    data_dir = DATA_DIR if data_dir is None else Path(data_dir)
+    cache = _cache.setdefault(data_dir, {'signature': None, 'frames': {}})
+    signature = store_signature(data_dir)
+    if signature != cache['signature']:
+        cache['signature'], cache['frames'] = signature, {}
+
+    key = (
+        None if columns is None else tuple(columns),
+        None if start is None else pd.Timestamp(start),
+        None if end is None else pd.Timestamp(end),
+    )
+    if key not in cache['frames']:
+        cache['frames'][key] = _read_only(_load_transactions(columns, start, end, data_dir))
+
+    return cache['frames'][key].copy(deep=False)
+
+def store_signature(data_dir=None):
+    '''Returns:
+        tuple: Path, mtime and content hash of each store partition's metadata (or of each legacy pickle)
+    '''
+    data_dir = DATA_DIR if data_dir is None else Path(data_dir)
+    metas = sorted(data_dir.glob('store/FY*/meta.json'))
+    if metas:
+        return tuple((str(meta), meta.stat().st_mtime_ns, hashlib.sha1(meta.read_bytes()).hexdigest()) for meta in metas)
+
+    return tuple((str(pickle), pickle.stat().st_mtime_ns, pickle.stat().st_size) for pickle in sorted(data_dir.glob('*.pkl')))
+
+def clear_cache():
+    _cache.clear()
+
+def _read_only(txs_df):
+    for column in txs_df.columns:
+        values = txs_df[column].array
+        array = values.codes if hasattr(values, 'codes') else txs_df[column].to_numpy()
+        while isinstance(array, np.ndarray):  # Views share their base's buffer, so lock the whole chain
+            array.flags.writeable = False
+            array = array.base
+
+    return txs_df
+
+def _load_transactions(columns=None, start=None, end=None, data_dir=DATA_DIR):
+    # Pickles written before the columnar store existed
+    pickles = sorted(list(data_dir.glob('*.pkl')))
+    if store.exists(data_dir / 'store') or not pickles:
+        return store.read(columns, start, end, data_dir / 'store')
+
     frames = [ pd.read_pickle(pickle) for pickle in pickles ]
+    txs_df = pd.concat(frames).sort_values(['Date','Volume'],ascending=[True,False]).loc[start:end]
 
-    return pd.concat(frames)
+    return txs_df if columns is None else txs_df[columns]
 
-def history(current=False):
-    txs_df = transactions()
-    txs_df['Value'] = txs_df['Volume'] * txs_df['PriceIncBrokerage']
-    portfolio_dict = dict.fromkeys(txs_df['Ticker'].unique())
-
-    for ticker in portfolio_dict.keys():
-        value = txs_df[txs_df['Ticker'] == ticker]['Value'].cumsum().tolist()[-1]
-        volume = txs_df[txs_df['Ticker'] == ticker]['Volume'].cumsum().tolist()[-1]
-        cash_ins = txs_df[(txs_df['Ticker'] == ticker) & (txs_df['Type'] == 'B')]['Value'].cumsum().tolist()
-        cash_outs = txs_df[(txs_df['Ticker'] == ticker) & (txs_df['Type'] == 'S')]['Value'].cumsum().tolist()
-        
-        portfolio_dict[ticker] = {
-            'Value':                value,
-            'Cash in':              cash_ins[-1],
-            'Cash out':             cash_outs[-1] if len(cash_outs) > 0 else 0,
-            'Volume':               volume,
-            'PriceIncBrokerage':    value/volume if volume > 0 else np.nan,
-        }
-
-    portfolio_df = pd.DataFrame.from_dict(portfolio_dict, orient='index')
-    
-    if current:
-      portfolio_df = portfolio_df[portfolio_df['Volume'] > 0]
-      
-    return portfolio_df.sort_index()
+def ticker_codes(txs_df):
+    '''Factorizes the Ticker column, in ticker order
+
+    Returns:
+        tuple: (numpy.ndarray code of each transaction, pandas.Index of tickers)
 
+    Raises:
+        ValueError: When a transaction has no ticker, listing their dates
+    '''
+    codes, tickers = pd.factorize(txs_df['Ticker'], sort=True)
+    missing = codes < 0
+    if missing.any():
+        dates = ', '.join(f'{date:%Y-%m-%d}' for date in txs_df.index[missing])
+        raise ValueError(f'Transactions without a ticker on: {dates}')
 
+    return codes, tickers
+
+class TickerIndex():
+    '''Transactions grouped by ticker: rows are sorted by ticker, keeping date order (buys on top for intra-day
+    trades) within each ticker, and each ticker's rows are one contiguous slice of `frame`
+    '''
+    def __init__(self, txs_df):
+        codes, tickers = ticker_codes(txs_df)
+        order = np.argsort(codes, kind='stable')
+
+        self.frame = txs_df.iloc[order]
+        self.tickers = [str(ticker) for ticker in tickers]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(tickers)))])
+        self.__positions = {ticker: i for i, ticker in enumerate(self.tickers)}
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def __contains__(self, ticker):
+        return ticker in self.__positions
+
+    def __getitem__(self, ticker):
+        start, stop = self.bounds(ticker)
+        return self.frame.iloc[start:stop]
+
+    def bounds(self, ticker):
+        '''Returns:
+            tuple: (start, stop) row positions of `ticker` in `frame`
+        '''
+        i = self.__positions[ticker]
+        return self.offsets[i], self.offsets[i + 1]
+
+    def items(self):
+        for i, ticker in enumerate(self.tickers):
+            yield ticker, self.frame.iloc[self.offsets[i]:self.offsets[i + 1]]
+
+def positions(as_of=None, current=False, data_dir=None):
+    '''Position of every ticker from one grouped aggregation of the transactions
+
+    Args:
+        as_of (str or datetime, optional): Last date to include. Defaults to every transaction.
+        current (bool, optional): Only tickers still held. Defaults to False.
+        data_dir (Path, optional): Portfolio data folder. Defaults to DATA_DIR.
+
+    Returns:
+        pandas.DataFrame: Ticker indexed [Value, Cash in, Cash out, Volume, PriceIncBrokerage], where Value is the
+            net cash invested and PriceIncBrokerage the average cost of the units held
+    '''
+    txs_df = transactions(['Type', 'Volume', 'Ticker', 'PriceIncBrokerage'], end=as_of, data_dir=data_dir)
+    codes, tickers = ticker_codes(txs_df)
+    volumes = txs_df['Volume'].to_numpy(dtype='int64')
+    values = volumes * txs_df['PriceIncBrokerage'].to_numpy(dtype='float64')
+    buys = (txs_df['Type'] == 'B').to_numpy()
+
+    def total(weights):
+        return np.bincount(codes, weights=weights, minlength=len(tickers))
+
+    positions_df = pd.DataFrame({
+        'Value': total(values),
+        'Cash in': total(np.where(buys, values, 0)),
+        'Cash out': total(np.where(buys, 0, values)),
+        'Volume': total(volumes).astype('int64'),
+    }, index=pd.Index([str(ticker) for ticker in tickers], name='Ticker'))
+    held = positions_df['Volume'] > 0
+    positions_df['PriceIncBrokerage'] = (positions_df['Value'] / positions_df['Volume']).where(held)
+
+    return positions_df[held] if current else positions_df
+
+def history(current=False):
+    return positions(current=current)
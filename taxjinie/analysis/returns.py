@@ -0,0 +1,308 @@
+'''Return metrics of every ticker and the whole portfolio
+
+Time-weighted returns chain daily growth factors around the trades, which are external cashflows of a ticker.
+Cashflows happen at the end of the day, except that a position opened from nothing grows from its cost:
+
+    growth = (value + cash out - cash in) / previous value
+    growth = (value + cash out) / cash in                       when nothing was held the day before
+
+Daily log growth is cumulatively summed down a (dates, tickers + portfolio) array once, so the return of any
+window is the difference of two rows, and MTD, FYTD and rolling 1 or 3 year returns of every ticker are a few
+array operations.
+
+Money-weighted returns (XIRR) take the dated trade cashflows, plus what is still held as a final cashflow, and
+solve every series at once, e.g. per ticker, for the whole portfolio or per client of a batch book:
+
+    irr(Performance().txs)
+    irr(Performance().txs, by=None)
+    irr(batch.book_transactions(roots, 2022), by='Portfolio')
+'''
+import numpy as np
+import pandas as pd
+
+# Local imports
+from . import portfolio, performance
+from .holdings import Holdings
+
+WINDOWS = {'MTD': ('M', None), 'FYTD': ('FY', None), '1Y': (None, 1), '3Y': (None, 3)}
+XIRR_TOLERANCE = 1e-10  # Relative change in rate at which a series has converged
+NEWTON_ITERATIONS = 50
+BISECTION_ITERATIONS = 200
+BRACKET_RATES = np.concatenate([np.geomspace(1e-6, 1, 25) - 1, np.geomspace(1e-3, 1e3, 25)])
+
+class TimeWeightedReturns():
+    '''Time-weighted returns over any window, for every ticker and the portfolio
+
+    Attributes:
+        dates (pandas.DatetimeIndex): Days of the holdings
+        columns (list): Tickers, then 'Portfolio'
+        log_growth (numpy.ndarray): (dates + 1, columns) cumulative log growth, from 0 before the first day
+        unvalued (numpy.ndarray): (dates + 1, columns) cumulative count of days that could not be valued, e.g. a
+            holding without a price. Returns over windows that include such a day are NaN
+    '''
+    def __init__(self, holdings, txs_df, prices=None):
+        '''
+        Args:
+            holdings (Holdings): Daily holdings built from `txs_df`
+            txs_df (pandas.DataFrame): Date indexed transactions with [Ticker, Volume, PriceIncBrokerage]
+            prices (pandas.DataFrame, optional): Closing prices to value holdings with, see `Holdings.values`.
+                Defaults to the last traded prices.
+        '''
+        self.dates = holdings.dates
+        self.columns = holdings.tickers + ['Portfolio']
+
+        cashflows = txs_df['Volume'].to_numpy(dtype='float64') * txs_df['PriceIncBrokerage'].to_numpy(dtype='float64')
+        values = _with_total(holdings.values(prices))
+        cash_in = _with_total(holdings.pivot(txs_df, np.where(cashflows > 0, cashflows, 0)))
+        cash_out = _with_total(holdings.pivot(txs_df, np.where(cashflows < 0, -cashflows, 0)))
+
+        previous = np.zeros_like(values)
+        previous[1:] = values[:-1]
+        held = previous > 0
+        start = np.where(held, previous, cash_in)
+        end = values + cash_out - np.where(held, cash_in, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_growth = np.log(np.where(start > 0, end / start, 1))
+        unvalued = np.isnan(log_growth) | np.isnan(values) | np.isnan(previous)
+        log_growth[unvalued] = 0
+
+        self.log_growth = np.zeros((len(self.dates) + 1, len(self.columns)))
+        np.cumsum(log_growth, axis=0, out=self.log_growth[1:])
+        self.unvalued = np.zeros((len(self.dates) + 1, len(self.columns)), dtype='int64')
+        np.cumsum(unvalued, axis=0, out=self.unvalued[1:])
+
+    @classmethod
+    def from_store(cls, end=None, prices=None, weekdays=False, data_dir=None):
+        '''Returns from the transaction store, see `portfolio.transactions`'''
+        txs_df = portfolio.transactions(['Ticker', 'Volume', 'Price', 'PriceIncBrokerage'], end=end, data_dir=data_dir)
+        return cls(Holdings(txs_df, end=end, weekdays=weekdays), txs_df, prices)
+
+    def between(self, start, end):
+        '''Returns:
+            pandas.Series: Return of each column from the end of `start` to the end of `end`
+        '''
+        return pd.Series(np.expm1(self.__growth(self.__row(end), self.__row(start))), index=self.columns)
+
+    def to_date(self, freq='M', as_of=None):
+        '''Period to date returns, e.g. 'M' for MTD or 'FY' for FYTD, see `performance.FREQUENCIES`
+
+        Args:
+            as_of (str or datetime, optional): Defaults to the last day.
+
+        Returns:
+            pandas.Series: Return of each column since the end of the previous period, NaN without history
+        '''
+        if as_of is None and len(self.dates) == 0:
+            return pd.Series(np.nan, index=self.columns)
+        as_of = self.dates[-1] if as_of is None else pd.Timestamp(as_of)
+        period_start = pd.Period(as_of, performance.FREQUENCIES.get(freq, freq)).start_time
+        return self.between(period_start - pd.Timedelta(days=1), as_of)
+
+    def rolling(self, years=1):
+        '''Returns:
+            pandas.DataFrame: (dates, columns) return over the `years` years to each day, NaN until there is that
+                much history
+        '''
+        starts = self.dates - pd.DateOffset(years=years)
+        start_rows = np.searchsorted(self.dates, starts, side='right')
+        growth = self.__growth(slice(1, None), start_rows)
+        growth[starts < self.dates[0] - pd.Timedelta(days=1)] = np.nan
+        return pd.DataFrame(np.expm1(growth), index=self.dates, columns=self.columns)
+
+    def summary(self, as_of=None):
+        '''Returns:
+            pandas.DataFrame: MTD, FYTD, 1Y and 3Y returns of every column as of a day, defaulting to the last.
+                Rolling returns are NaN without that much history. Empty without any history
+        '''
+        if len(self.dates) == 0:
+            return pd.DataFrame(columns=self.columns, dtype='float64')
+        as_of = self.dates[-1] if as_of is None else pd.Timestamp(as_of)
+        windows = {}
+        for name, (freq, years) in WINDOWS.items():
+            if freq is not None:
+                windows[name] = self.to_date(freq, as_of)
+            elif as_of - pd.DateOffset(years=years) < self.dates[0] - pd.Timedelta(days=1):
+                windows[name] = pd.Series(np.nan, index=self.columns)
+            else:
+                windows[name] = self.between(as_of - pd.DateOffset(years=years), as_of)
+        return pd.DataFrame(windows).T
+
+    def __growth(self, end_rows, start_rows):
+        # Log growth between rows of `log_growth`, NaN across days that could not be valued
+        growth = self.log_growth[end_rows] - self.log_growth[start_rows]
+        return np.where(self.unvalued[end_rows] == self.unvalued[start_rows], growth, np.nan)
+
+    def __row(self, date):
+        # Row of `log_growth` at the end of `date`
+        return np.searchsorted(self.dates, pd.Timestamp(date), side='right')
+
+def irr(txs_df, by='Ticker', as_of=None, prices=None):
+    '''Money-weighted return (XIRR) of each group of transactions, with what is still held valued as a final
+    cashflow on `as_of`
+
+    Args:
+        txs_df (pandas.DataFrame): Date indexed transactions with [Ticker, Volume, Price, PriceIncBrokerage] and any
+            `by` columns, e.g. Portfolio from `batch.book_transactions`. CashflowIncBrokerage is used when present,
+            see `Performance.calculate_tx_cashflows`
+        by (str or list, optional): Columns to group by, or None for the whole portfolio. Defaults to 'Ticker'.
+        as_of (str or datetime, optional): Valuation day. Defaults to the last transaction.
+        prices (pandas.Series, optional): Ticker indexed prices on `as_of`. Defaults to the last traded prices.
+
+    Returns:
+        pandas.DataFrame: Per group, see `xirr`
+    '''
+    by = [] if by is None else [by] if isinstance(by, str) else list(by)
+    if as_of is not None:
+        txs_df = txs_df.loc[:pd.Timestamp(as_of)]
+    as_of = txs_df.index.max() if as_of is None else pd.Timestamp(as_of)
+
+    if 'CashflowIncBrokerage' in txs_df:
+        invested = txs_df['CashflowIncBrokerage'].to_numpy(dtype='float64')
+    else:
+        invested = txs_df['Volume'].to_numpy(dtype='float64') * txs_df['PriceIncBrokerage'].to_numpy(dtype='float64')
+    flows_df = pd.DataFrame({
+        **{column: txs_df[column].to_numpy() for column in by}, 'Date': txs_df.index.to_numpy(), 'Amount': -invested,
+    })
+
+    # Units still held, valued on `as_of`
+    held = txs_df.groupby(list(dict.fromkeys(by + ['Ticker'])), observed=True).agg(
+        Volume=('Volume', 'sum'), Price=('Price', 'last'),
+    ).reset_index()
+    held = held[held['Volume'] != 0]
+    if prices is not None:
+        held['Price'] = held['Ticker'].astype(str).map(pd.Series(prices)).fillna(held['Price'])
+    cashflows_df = pd.concat([flows_df, pd.DataFrame({
+        **{column: held[column].to_numpy() for column in by}, 'Date': as_of, 'Amount': held['Volume'] * held['Price'],
+    })], ignore_index=True)
+
+    if by:
+        grouped = cashflows_df.groupby(by, observed=True)
+        groups, labels = grouped.ngroup().to_numpy(), grouped.size().index
+    else:
+        groups, labels = np.zeros(len(cashflows_df), dtype='int64'), pd.Index(['Portfolio'])
+
+    irr_df = xirr(cashflows_df['Amount'].to_numpy(), cashflows_df['Date'].to_numpy(), groups)
+    return irr_df.set_index(labels).sort_index()
+
+def xirr(amounts, dates, groups, tolerance=XIRR_TOLERANCE):
+    '''Annual rates (365 day years) that bring the net present value of each cashflow series to zero, for many
+    series at once
+
+    Newton steps run on every unconverged series together, as array operations over all the cashflows with a
+    segment sum per series. Series Newton does not settle, or that step to -100% or below, are bracketed and
+    bisected the same way.
+
+    Args:
+        amounts (numpy.ndarray): Cashflows, negative for money invested
+        dates (numpy.ndarray): datetime64 date of each cashflow
+        groups (numpy.ndarray): Series of each cashflow, numbered from 0
+
+    Returns:
+        pandas.DataFrame: Per series: [IRR, Converged, Method, Iterations, NPV, Cashflows], NPV being the value
+            left at the rate found as a share of the series' gross discounted cashflows. Series without both
+            inflows and outflows have no rate
+    '''
+    flows = _Flows(amounts, dates, groups)
+    count = len(flows.starts)
+    solvable = (flows.sums(flows.amounts > 0) > 0) & (flows.sums(flows.amounts < 0) > 0)
+
+    rates = np.where(solvable, 0.1, np.nan)
+    iterations = np.zeros(count, dtype='int64')
+    converged = np.zeros(count, dtype=bool)
+    active = solvable.copy()
+    with np.errstate(all='ignore'):
+        for _ in range(NEWTON_ITERATIONS):
+            if not active.any():
+                break
+            value, slope = flows.npv(rates)
+            step = value / slope
+            stepped = rates - step
+            invalid = ~np.isfinite(stepped) | (stepped <= -1)
+            stepped = np.where(invalid, (rates - 1) / 2, stepped)  # Halfway to -100% instead
+
+            settled = active & ~invalid & (np.abs(step) <= tolerance * (1 + np.abs(rates)))
+            rates = np.where(active, stepped, rates)
+            iterations += active
+            converged |= settled
+            active &= ~settled
+
+        bisected = solvable & ~converged
+        if bisected.any():
+            subset = flows.subset(bisected)
+            rates[bisected], bisection_converged, bisection_iterations = _bisect(subset, tolerance)
+            converged[bisected] = bisection_converged
+            iterations[bisected] += bisection_iterations
+
+        discounted = flows.discounted(np.where(solvable, rates, 0))
+        residual = flows.sums(discounted) / flows.sums(np.abs(discounted))
+
+    return pd.DataFrame({
+        'IRR': np.where(converged, rates, np.nan),
+        'Converged': converged,
+        'Method': np.where(bisected, 'bisection', np.where(solvable, 'newton', '')),
+        'Iterations': iterations,
+        'NPV': np.where(solvable, residual, np.nan),
+        'Cashflows': np.diff(np.append(flows.starts, len(flows.amounts))),
+    })
+
+def _bisect(flows, tolerance):
+    # Brackets each series by the sign change of NPV over a grid of rates nearest 0%, as series with several
+    # roots can have the same sign at either end
+    count = len(flows.starts)
+    values = np.array([flows.npv(np.full(count, rate))[0] for rate in BRACKET_RATES])
+    changes = (np.sign(values[:-1]) * np.sign(values[1:]) < 0)
+    nearest = np.argmin(np.where(changes, np.abs(BRACKET_RATES[:-1] + BRACKET_RATES[1:])[:, None], np.inf), axis=0)
+    bracketed = changes.any(axis=0)
+    low, high = BRACKET_RATES[nearest], BRACKET_RATES[nearest + 1]
+    low_value = values[nearest, np.arange(count)]
+
+    iterations = np.zeros(count, dtype='int64')
+    active = bracketed.copy()
+    for _ in range(BISECTION_ITERATIONS):
+        if not active.any():
+            break
+        middle = (low + high) / 2
+        middle_value = flows.npv(middle)[0]
+        lower = np.sign(middle_value) == np.sign(low_value)
+        low = np.where(active & lower, middle, low)
+        low_value = np.where(active & lower, middle_value, low_value)
+        high = np.where(active & ~lower, middle, high)
+        iterations += active
+        active &= (high - low) > tolerance * (1 + np.abs(middle))
+
+    return np.where(bracketed, (low + high) / 2, np.nan), bracketed & ~active, iterations
+
+class _Flows():
+    # Cashflows sorted by series, with each series' flows one contiguous segment
+    def __init__(self, amounts, dates, groups):
+        groups = np.asarray(groups, dtype='int64')
+        days = np.asarray(dates).astype('datetime64[D]').astype('int64')
+        order = np.lexsort((days, groups))
+        self.groups = groups[order]
+        self.amounts = np.asarray(amounts, dtype='float64')[order]
+        self.starts = np.flatnonzero(np.diff(self.groups, prepend=-1))
+        self.groups = np.cumsum(np.diff(self.groups, prepend=-1) != 0) - 1  # Series without flows are dropped
+        days = days[order]
+        self.years = (days - days[self.starts][self.groups]) / 365
+
+    def sums(self, values):
+        return np.add.reduceat(values, self.starts) if len(self.starts) else np.zeros(0)
+
+    def discounted(self, rates):
+        return self.amounts * np.exp(-self.years * np.log1p(rates)[self.groups])
+
+    def npv(self, rates):
+        # Net present value of each series at its rate, and its derivative in the rate
+        discounted = self.discounted(rates)
+        return self.sums(discounted), -self.sums(self.years * discounted) / (1 + rates)
+
+    def subset(self, series):
+        flows = _Flows.__new__(_Flows)
+        kept = series[self.groups]
+        flows.amounts, flows.years = self.amounts[kept], self.years[kept]
+        flows.groups = (np.cumsum(series) - 1)[self.groups[kept]]
+        flows.starts = np.flatnonzero(np.diff(flows.groups, prepend=-1))
+        return flows
+
+def _with_total(array):
+    return np.column_stack([array, array.sum(axis=1)])
@@ -5,16 +5,46 @@ from datetime import datetime
 import textwrap
 
 # Local imports
-from . import portfolio
+from transactions import store
+from . import portfolio, lots, checkpoints
 
-class Tax():
-    def __init__(self, financial_year:int=2021) -> None:
-        self.transactions = portfolio.transactions()
-        self.cgt_log = []
-        self.all_cg_events = pd.DataFrame()
+CGT_COLUMNS = ['Ticker','Volume','Price','PriceIncBrokerage']
+REPORTS_DIR = Path(__file__).parent.parent / 'reports'
 
+class Tax():
+    def __init__(self, financial_year:int=2021, data_dir=None, transactions=None, reports_dir=REPORTS_DIR) -> None:
+        '''
+        Args:
+            financial_year (int, optional): Financial year end, e.g. 2021 for FY2020-21. Defaults to 2021.
+            data_dir (Path, optional): Portfolio data folder, see `portfolio.transactions`. Defaults to None.
+            transactions (pandas.DataFrame, optional): Transactions to use instead of loading them from `data_dir`,
+                with at least CGT_COLUMNS. Defaults to None.
+            reports_dir (Path, optional): Folder reports are saved to. Defaults to REPORTS_DIR.
+        '''
         self.__fy_end = financial_year
         self.__fy_start = self.fy_end - 1
+        self.data_dir = portfolio.DATA_DIR if data_dir is None else Path(data_dir)
+        self.reports_dir = Path(reports_dir)
+
+        # CGT only needs history up to the end of the financial year being reported
+        if transactions is None:
+            transactions = portfolio.transactions(columns=CGT_COLUMNS, end=f'{self.fy_end}-06-30', data_dir=self.data_dir)
+        self.transactions = transactions
+        self.tickers = portfolio.TickerIndex(self.transactions)
+        self.__dates = self.tickers.frame.index.to_numpy()
+        self.__volumes = self.tickers.frame['Volume'].to_numpy()
+        self.__prices = self.tickers.frame['PriceIncBrokerage'].to_numpy()
+
+        self.method = 'lifo'
+        self.matches = None  # Sell to buy parcel links, see lots.Matches
+        self.audit = None    # The same links with the sales and parcels they refer to, see lots.AuditLog
+        self.open_lots = None
+        self.__selections = {}  # Specific identification selections of the last match, by row
+        self.__sale_fys = None  # Financial year of each sale in the audit log
+        self.__discount_index = None
+        self.__simulator = None
+        self.__cgt_log = None
+        self.all_cg_events = pd.DataFrame()
 
     @property
     def fy_end(self):
@@ -35,115 +65,117 @@ class Tax():
         self.__fy_start = self.fy_end - 1
         return self.__fy_start
     
-    def capital_gain_events(self):
-        '''Loops through and calculates capital gains for each ticker
+    def capital_gain_events(self, method='lifo', selections=None, incremental=False, workers=None):
+        '''Calculates capital gains for every ticker in one pass of the lot matching engine
+
+        Args:
+            method (str, optional): Cost basis method, one of `lots.METHODS`. 'mintax' picks the parcels with the
+                lowest taxable gain for each sale. Defaults to 'lifo'.
+            selections (dict, optional): Buy parcels used by each sale for the 'specific' method, as
+                {(ticker, sell date): [buy date, ...]}. When a ticker has several sales on one day, key each with
+                (ticker, sell date, n) for the n-th sale that day in transaction order, from 0. Units not covered
+                fall back to LIFO. Defaults to None.
+            incremental (bool, optional): Only rematch tickers with transactions changed since the last
+                checkpoint of `method`, see checkpoints.py. Checkpoints do not record selections, so specific
+                identification always rematches everything. Defaults to False.
+            workers (int, optional): Processes to shard tickers across, see `lots.match_parallel`. Defaults to the
+                CPU count.
         '''
-        for ticker in self.transactions['Ticker'].unique():
-            ticker_capital_gain_events = self.__ticker_cg(ticker)
-            if len(ticker_capital_gain_events) > 0:
-                self.all_cg_events = pd.concat([self.all_cg_events,ticker_capital_gain_events])
-        
-        self.all_cg_events = self.all_cg_events.set_index('Date').sort_index()
+        if incremental and method != 'specific' and not selections:
+            self.load_audit(*checkpoints.match(self.transactions, method, self.data_dir / '.cgt', workers), method)
+            return
+
+        selection_rows = self.__selection_rows(selections or {})
+        matches = lots.match_parallel(
+            self.__volumes, self.tickers.offsets, self.tickers.tickers, method, self.__prices, self.__dates,
+            selection_rows, workers,
+        )
+        frame = self.tickers.frame
+        self.load_audit(lots.AuditLog.from_matches(matches, frame), lots.open_lot_table(matches, frame), method)
+        self.matches = matches
+        self.__selections = selection_rows
+
+    def load_audit(self, audit, open_lots=None, method='lifo'):
+        '''Uses sales already matched to lots, e.g. one client's share of a batch run (see batch.py)
 
-    def __ticker_cg(self, ticker):
-        '''Calculates capital gains using Last in, first out logic
+        Args:
+            audit (lots.AuditLog): Matched sales
+            open_lots (pandas.DataFrame, optional): Lots left open, see `lots.open_lot_table`. Defaults to None.
+            method (str, optional): Cost basis method the sales were matched with. Defaults to 'lifo'.
         '''
-        tx_df = self.transactions[self.transactions['Ticker'] == ticker]
-        dates = list(tx_df.index)
-
-        txs = tx_df.to_dict('list')     # For easier sequential access to each row
-        buy_queue = []                  # Flush for new ticker
-        cgt_events=  []                 # Flush for new ticker
-
-        for i, date in enumerate(dates):
-            tx_dict = {
-                'Ticker': ticker,
-                'Date': date,
-                'Volume': txs['Volume'][i],
-                'Price': txs['Price'][i],
-                'PriceIncBrokerage': txs['PriceIncBrokerage'][i],
-            }
-            tx_dict['Brokerage'] = np.abs(tx_dict['Volume'] * (tx_dict['PriceIncBrokerage'] - tx_dict['Price']))
-            tx_vol = tx_dict['Volume']  # Simpler to read
-            tx_cg, tx_cg_taxable = 0, 0  # Reset to 0 for each new tx
-
-            if tx_vol > 0:  # Buys in queue
-                buy_queue.append(tx_dict)
-            else:  # Sells reduced by
-                buy_logs = []                                       # Flush buy logs
-                
-                while tx_vol != 0:                                  # Loop until all the sold volume is accounted for
-                    try:
-                        type(buy_queue[-1])                         # Check for any missing buy transactions
-                    except IndexError as err:
-                        raise(f'{err}: There is a missing buy transaction for {ticker}, with volume: {abs(tx_vol)}')
-
-                    if buy_queue[-1]['Volume'] == 0:                # Catch any 0 volume buy parcels
-                        buy_parcel = buy_queue.pop()
-                        continue
-                    elif abs(tx_vol) < buy_queue[-1]['Volume']:     # Sell volume is less than or equal to previous buy volume
-                        cg, cg_taxable = self.__cg_calc(buy_queue[-1], tx_dict, limiter='sell')
-                        buy_log = buy_queue[-1].copy()              # For logging - initial shares in buy_parcel
-                        buy_queue[-1]['Volume'] += tx_vol           # Reduce LIFO buy_volume by sale_volume (sale_volume is negative)
-                        tx_vol = 0
-                    else:                                           # Sell volume greater than previous buy volume
-                        buy_parcel = buy_queue.pop()                # Remove buy_parcel from buy_queue as it has been depleted
-                        cg, cg_taxable = self.__cg_calc(buy_parcel, tx_dict, limiter='buy')
-                        buy_log = buy_parcel.copy()                 # For logging - remaining shares in buy_parcel
-                        tx_vol += buy_parcel['Volume']              # Increase sale_volume by LIFO buy_volume (sale_volume is negative)
-                    
-                    tx_cg += cg
-                    tx_cg_taxable += cg_taxable
-                    buy_logs.append(buy_log)                        # Keep log of buys associated with sale
-
-                cgt_detailed_log = { # Log event for reporting
-                    'Ticker': ticker,
-                    'Date': date,
-                    'Volume': txs['Volume'][i],
-                    'Capital Gains': tx_cg,
-                    'Capital Gains Taxable': tx_cg_taxable,
-                    'Buy Parcels': buy_logs,
-                    'Sell Parcel': tx_dict,
-                }
-                self.cgt_log.append(cgt_detailed_log)
-
-                cgt_event = {  # Dict to store capital gain event
-                    'Ticker': ticker,
-                    'Date': date,
-                    'Capital Gains': tx_cg,
-                    'Capital Gains Taxable': tx_cg_taxable,
-                    }
-                cgt_events.append(cgt_event)
-
-        return pd.DataFrame(cgt_events)
-    
-    def __cg_calc(self, buy_parcel, sell_parcel, limiter='buy'):  # Aux function
-        '''Calculates capital gains given buy and sell parcels, using the the buy or sell volume. Considers brokerage as tax deductible
-        
-        Arguments:
-            buy_parcel {dict} -- Requires keys: [Date, Volume, TradePrice, Brokerage]
-            sell_parcel {dict} -- Requires keys: [Date, Volume, TradePrice, Brokerage]
-            limiter {string} -- ['buy','sell']; Defines the buy or sell volume as the limiting volume for the calculation
+        self.method = method
+        self.matches = None
+        self.audit = audit
+        self.open_lots = open_lots
+        self.__selections = {}
+        self.__sale_fys = store.financial_year(audit.sales['Date'])
+        self.all_cg_events = self.__cg_events(audit, self.__sale_fys)
+        self.__discount_index = None
+        self.__simulator = None
+        self.__cgt_log = None
+
+    def __cg_events(self, audit, sale_fys=None):
+        cg_events = audit.sales[['Date', 'Ticker', 'Capital Gains', 'Capital Gains Taxable']]
+        if sale_fys is not None:
+            cg_events = cg_events.assign(FY=sale_fys)
+        return cg_events.astype({'Ticker': object}).set_index('Date').sort_index()
+
+    def compare_methods(self, methods=('lifo', 'fifo', 'hifo', 'mintax')):
+        '''Capital gains for the financial year under several cost basis methods, matched in a single pass
+
         Returns:
-            float -- calculated capital gains
+            pandas.DataFrame: Capital Gains, Capital Gains Taxable and the taxable gain saved versus LIFO per method
         '''
-        if limiter not in ['buy','sell']:
-            raise ValueError(f'Invalid partial type. Expected one of: ["buy","sell"]')
-        if limiter == 'buy':  # More buy volume than sell volume
-            volume = buy_parcel['Volume']
-        else:  # More sell volume than buy volume
-            volume = abs(sell_parcel['Volume'])
-
-        buy_value = volume * buy_parcel['PriceIncBrokerage']  # PriceIncBrokerage incldues brokerage
-        sell_value = volume * sell_parcel['PriceIncBrokerage']  # PriceIncBrokerage incldues brokerage
-
-        cg = sell_value - buy_value
-        if ((sell_parcel['Date'] - buy_parcel['Date']).days > 365) and (cg > 0):
-            cg_taxable = cg / 2 # Apply any capital gains discounts if applicable
-        else:
-            cg_taxable = cg
-        
-        return cg, cg_taxable
+        methods = ['lifo'] + [method for method in methods if method != 'lifo']
+        all_matches = lots.match_methods(
+            self.__volumes, self.tickers.offsets, self.tickers.tickers, methods, self.__prices, self.__dates
+        )
+
+        totals = {}
+        for method, matches in all_matches.items():
+            cg_events = self.__cg_events(lots.AuditLog.from_matches(matches, self.tickers.frame))
+            fy_df = cg_events.loc[f'{self.fy_start}-07-01':f'{self.fy_end}-06-30']
+            totals[method.upper()] = fy_df[['Capital Gains', 'Capital Gains Taxable']].sum()
+
+        comparison_df = pd.DataFrame(totals).T
+        comparison_df['Saving vs LIFO'] = comparison_df.loc['LIFO', 'Capital Gains Taxable'] - comparison_df['Capital Gains Taxable']
+        print(f'Capital gains for \tFY{self.fy_start}-{self.fy_end} by method\n{comparison_df.round(2)}\n')
+        return comparison_df
+
+    def __selection_rows(self, selections):
+        # {(ticker, sell date[, n]): [buy date, ...]} -> {sell row: [lot row, ...]}
+        rows = {}
+        for key, buy_dates in selections.items():
+            ticker, sell_date, *nth = key
+            lo, hi = self.tickers.bounds(ticker)
+            dates, volumes = self.__dates[lo:hi], self.__volumes[lo:hi]
+            sells = np.flatnonzero((dates == np.datetime64(pd.Timestamp(sell_date))) & (volumes <= 0))
+            if len(sells) == 0:
+                raise ValueError(f'No sale of {ticker} on {sell_date}')
+            if not nth and len(sells) > 1:
+                raise ValueError(
+                    f'{len(sells)} sales of {ticker} on {sell_date}, key each selection with '
+                    f'({ticker!r}, {sell_date!r}, n) for the n-th sale that day'
+                )
+            if nth and not 0 <= nth[0] < len(sells):
+                raise ValueError(f'No sale {nth[0]} of {ticker} on {sell_date}, there are {len(sells)}')
+
+            lot_rows = []
+            for buy_date in buy_dates:
+                buys = np.flatnonzero((dates == np.datetime64(pd.Timestamp(buy_date))) & (volumes > 0))
+                if len(buys) == 0:
+                    raise ValueError(f'No buy of {ticker} on {buy_date}')
+                lot_rows.extend(lo + buys)
+            rows[lo + sells[nth[0] if nth else 0]] = lot_rows
+        return rows
+
+    @property
+    def cgt_log(self):
+        '''Nested log of each sale and the buy parcels matched to it, materialised from the audit log on first use
+        '''
+        if self.__cgt_log is None:
+            self.__cgt_log = [] if self.audit is None else self.audit.nested()
+        return self.__cgt_log
 
     def fy_view(self, summary = True):
         '''Returns view of capital gains for the given financial year.
@@ -157,20 +189,51 @@ class Tax():
         fy_df = self.all_cg_events.loc[f'{self.fy_start}-07-01':f'{self.fy_end}-06-30']
 
         if summary:
-            fy_df = fy_df.groupby('Ticker').sum()
+            fy_df = fy_df.groupby('Ticker')[['Capital Gains', 'Capital Gains Taxable']].sum()
         
         log_message = textwrap.dedent(f'''\
           Capital gains for \tFY{self.fy_start}-{self.fy_end}
           Total CG:\t\t ${fy_df['Capital Gains'].sum(): .2f}
           Total CGTaxable:\t ${fy_df['Capital Gains Taxable'].sum(): .2f}
-          (Uses LIFO method)
+          (Uses {self.method.upper()} method)
         ''')
         print(log_message)
 
         return fy_df
 
+    def fy_summary(self, by=('FY',)):
+        '''Capital gains of every financial year in the history, from one grouped aggregation of the sale to
+        parcel links. A 10 year history needs one `Tax` for the last year, not one per year
+
+        Args:
+            by (tuple, optional): Columns to group by, 'FY' and/or 'Ticker'. Defaults to ('FY',).
+
+        Returns:
+            pandas.DataFrame: Per group: Capital Gains, Capital Gains Taxable, Gains and Losses before discounts,
+                and the gains of discounted and of non-discounted parcels
+        '''
+        if self.audit is None:
+            self.capital_gain_events(method=self.method, incremental=True)
+
+        links = self.audit.links
+        sales = links['Sale'].to_numpy()
+        gains = links['Capital Gains'].to_numpy()
+        discounted = links['Discounted'].to_numpy()
+        links_df = pd.DataFrame({
+            'FY': self.__sale_fys[sales],
+            'Ticker': self.audit.sales['Ticker'].array.take(sales),
+            'Capital Gains': gains,
+            'Capital Gains Taxable': links['Capital Gains Taxable'].to_numpy(),
+            'Gains': np.where(gains > 0, gains, 0),
+            'Losses': np.where(gains < 0, gains, 0),
+            'Discounted Gains': np.where(discounted, gains, 0),
+            'Non-discounted Gains': np.where(~discounted & (gains > 0), gains, 0),
+        })
+        return links_df.groupby(list(by), observed=True).sum(numeric_only=True)
+
     def cgt_report(self, output_type='csv'):
-        '''Creates a .csv report of all capital gains events for the given year and the parcels involved
+        '''Creates a report of all capital gains events for the given year, and a second report of the buy parcels
+        matched to each sale
 
         Args:
             output_type (str, optional): Select output type, `excel` or `csv`. Defaults to 'csv'.
@@ -178,68 +241,125 @@ class Tax():
         Returns:
             pandas.DataFrame: CGT log for the selected financial year
         '''
-        df = pd.DataFrame(self.cgt_log).set_index('Date').sort_index()  # Dependent on how the data is logged in AutoTax!
-        df['Buys Associated'] = df.apply(lambda x: len(x['Buy Parcels']), axis=1)
-        fy_df = df.loc[f'{self.fy_start}-07-01':f'{self.fy_end}-06-30']
-        
-        fname = f'FY{self.fy_end}_cgt_report.csv'
-        if output_type == 'excel': self.__export_df_to_csv(fy_df,fname, excel = True)
-        else: self.__export_df_to_csv(fy_df,fname, excel = False)
+        sale_dates = self.audit.sales['Date']
+        fy_audit = self.audit.select((sale_dates >= f'{self.fy_start}-07-01') & (sale_dates <= f'{self.fy_end}-06-30'))
+        fy_df = fy_audit.sales.rename(columns={'Parcels': 'Buys Associated'}).rename_axis('Sale').reset_index()
+        fy_df = fy_df.set_index('Date').sort_index()
+
+        excel = output_type == 'excel'
+        self.__export_df_to_csv(fy_df, f'FY{self.fy_end}_cgt_report', excel=excel)
+        self.__export_df_to_csv(fy_audit.link_frame().set_index('Sale'), f'FY{self.fy_end}_cgt_parcels', excel=excel)
 
         return fy_df
 
-    def upcoming_cgtdiscounts(self):
-      today = datetime.today()
-      pastyear_df = self.transactions.loc[today - pd.DateOffset(years=1) : today]
-      buy_parcels_list = []
+    def open_lots_at(self, as_of):
+        '''Lots open at the end of `as_of`. Without trades after `as_of` these are the lots left open by
+        `capital_gain_events` (matched incrementally with the current method if it has not run), otherwise the
+        transactions up to `as_of` are matched again with the same method and selections
 
-      for ticker in pastyear_df['Ticker'].unique():
+        Raises:
+            ValueError: When `as_of` is after the financial year, as later trades are not loaded
 
-        ticker_df = pastyear_df[ pastyear_df['Ticker'] == ticker]
-        tx_list = ticker_df.reset_index().to_dict("records")
-        buy_parcels_ticker = []
+        Returns:
+            pandas.DataFrame: Date indexed open lots, see `lots.open_lot_table`
+        '''
+        as_of = pd.Timestamp(as_of).normalize()
+        if as_of > pd.Timestamp(f'{self.fy_end}-06-30'):
+            raise ValueError(
+                f'Trades are loaded up to the end of FY{self.fy_end}, use '
+                f'Tax({store.financial_year([as_of])[0]}) for the lots open on {as_of:%Y-%m-%d}'
+            )
+        if self.open_lots is None:
+            self.capital_gain_events(method=self.method, incremental=True)
+
+        kept = self.__dates < (as_of + pd.Timedelta(days=1)).to_datetime64()
+        if kept.all():
+            return self.open_lots
+
+        # Rows are grouped by ticker, so dropping later trades keeps each ticker's rows contiguous
+        kept_before = np.concatenate([[0], np.cumsum(kept)])
+        rows = kept_before[1:] - 1  # Row of each kept transaction among the kept ones
+        selections = {
+            rows[sell]: [rows[lot] for lot in lot_rows if kept[lot]]
+            for sell, lot_rows in self.__selections.items() if kept[sell]
+        }
+        matches = lots.match(
+            self.__volumes[kept], kept_before[self.tickers.offsets], self.tickers.tickers, self.method,
+            self.__prices[kept], self.__dates[kept], selections,
+        )
+        return lots.open_lot_table(matches, self.tickers.frame[kept])
 
-        for tx in tx_list:
-          if tx['Type'] == 'B':
-            buy_parcels_ticker.append(tx)
+    def discount_index(self, as_of=None):
+        '''Open lots ordered by the date they become eligible for the CGT discount
 
-          else:
-            try:
-              buy_parcels_ticker[-1]['Volume'] -= - tx['Volume']
+        Args:
+            as_of (str or datetime, optional): Index the lots open on this day, see `open_lots_at`. Defaults to the
+                lots open after the last trade.
 
-            except IndexError:
-              print(f'>> No buys for sale of {ticker} in past year <<')
-              continue
-        
-          # Only include buy parcels that have not been closed
-          if buy_parcels_ticker:
-            while buy_parcels_ticker[-1]['Volume'] <= 0:
-              try:
-                buy_parcels_ticker[-2]['Volume'] -= buy_parcels_ticker[-1]['Volume']
-                print(buy_parcels_ticker)
-                buy_parcels_ticker.pop()
-              
-              except IndexError:
-                print(f'>> {ticker} has been sold for this parcel <<')
-                buy_parcels_ticker.pop()
-                break
-              
-          
-        buy_parcels_list.append(buy_parcels_ticker)
-
-      buy_parcels_list = self.flatten(buy_parcels_list)
-
-      cgt_upcoming_df = pd.DataFrame(buy_parcels_list).set_index('Date')
-      cgt_upcoming_df['CGT Discount Date'] = cgt_upcoming_df.index + pd.DateOffset(years = 1)
-
-      self.__export_df_to_csv(
-        cgt_upcoming_df
-        , fname=f'upcoming_cgt_discounts_{today:%Y%m%d}'
-        , excel=True
-        )
+        Returns:
+            lots.DiscountIndex
+        '''
+        if as_of is None and len(self.__dates):
+            as_of = self.__dates.max()
+        day = None if as_of is None else np.datetime64(pd.Timestamp(as_of), 'D')
+        if self.__discount_index is None or self.__discount_index.as_of != day:
+            open_lots = self.open_lots_at(f'{self.fy_end}-06-30' if day is None else as_of)
+            self.__discount_index = lots.DiscountIndex(open_lots, day)
+        return self.__discount_index
+
+    def sale_simulator(self, as_of=None):
+        '''What-if sales against the lots open on `as_of`, see `open_lots_at`
+
+        Args:
+            as_of (str or datetime, optional): Day of the simulated sales, within or before the financial year.
+                Defaults to today.
+
+        Returns:
+            lots.SaleSimulator
+        '''
+        as_of = pd.Timestamp.today().normalize() if as_of is None else pd.Timestamp(as_of)
+        if self.__simulator is None or self.__simulator.as_of != np.datetime64(as_of, 'D'):
+            self.__simulator = lots.SaleSimulator(self.open_lots_at(as_of), as_of)
+        return self.__simulator
+
+    def simulate_sale(self, ticker, units, price, as_of=None, methods=('lifo', 'fifo', 'hifo', 'mintax')):
+        '''Capital gains of selling `units` of `ticker` at `price` (net of brokerage), under each cost basis method.
+        For many tickers and prices at once, use `sale_simulator().simulate`
+
+        Returns:
+            pandas.DataFrame: Cost, Proceeds, Capital Gains and Capital Gains Taxable per method
+        '''
+        simulator = self.sale_simulator(as_of)
+        return pd.DataFrame({
+            method.upper(): {column: values[0, 0] for column, values in simulator.simulate(ticker, units, price, method).items()}
+            for method in methods
+        }).T
+
+    def upcoming_cgtdiscounts(self, days=365, as_of=None, export=False, output_type='excel'):
+        '''Open parcels becoming eligible for the CGT discount within `days` after `as_of`
+
+        Args:
+            days (int, optional): Days to look ahead. Defaults to 365.
+            as_of (str or datetime, optional): Defaults to today.
+            export (bool, optional): Also save the parcels as a report. Defaults to False.
+            output_type (str, optional): Report type, `excel` or `csv`. Defaults to 'excel'.
+
+        Returns:
+            pandas.DataFrame: Open parcels with their Discount Date, in discount date order
+        '''
+        as_of = pd.Timestamp.today().normalize() if as_of is None else pd.Timestamp(as_of)
+        upcoming_df = self.discount_index(as_of).upcoming(days, as_of).set_index('Date')
+
+        if upcoming_df.empty:
+            print(f'>> No open parcels become eligible for the CGT discount in the {days} days from {as_of:%Y-%m-%d} <<')
+        elif export:
+            self.__export_df_to_csv(upcoming_df, f'upcoming_cgt_discounts_{as_of:%Y%m%d}', excel=output_type == 'excel')
+
+        return upcoming_df
 
     def __export_df_to_csv(self, df, fname:str, excel=False):
-        fpath = Path(__file__).parent.parent / 'reports' / fname
+        self.reports_dir.mkdir(parents=True, exist_ok=True)
+        fpath = self.reports_dir / fname
         if excel:
             fpath = fpath.with_suffix('.xlsx')
             df.to_excel(fpath.with_suffix('.xlsx'))
@@ -251,7 +371,5 @@ class Tax():
     def export_tx_history(self):
         fname = f'transaction_history_{datetime.today():%Y%m%d}'
 
-        self.__export_df_to_csv(self.transactions, fname, excel=True)
+        self.__export_df_to_csv(portfolio.transactions(data_dir=self.data_dir), fname, excel=True)
 
-    def flatten(self, t):
-      return [item for sublist in t for item in sublist]
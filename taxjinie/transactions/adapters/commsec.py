@@ -0,0 +1,49 @@
+'''Commsec transactions export: Date, Reference, Details, Debit($), Credit($), Balance($)
+'''
+import re
+import pandas as pd
+
+# Commsec trade details look like `B 830 RBL @ 2` or `S 16216 DRO @ 0.185000`
+COMMSEC_TRADE = re.compile(
+    r'^(?P<Type>[BS])\s+(?P<Volume>\d+(?:\.\d*)?)\s+(?P<Ticker>\S+)\s+@\s+(?P<Price>\d*\.?\d+)\s*$'
+)
+COMMSEC_TRADE_START = re.compile(r'^[BS]\s+\d')  # Anything starting like this is meant to be a trade
+
+def parse_details(details):
+    '''Extracts trade fields from Commsec `Details` strings in a single regex pass
+
+    Args:
+        details (pandas.Series): Raw `Details` column from a Commsec export
+
+    Returns:
+        pandas.DataFrame: Typed Type/Volume/Ticker/Price columns, only for rows that are trades.
+            Index is aligned with `details` so other raw columns can be joined on.
+
+    Raises:
+        ValueError: If a row starts like a trade but does not parse, rather than dropping the trade
+    '''
+    details = details.astype(str)
+    fields = details.str.extract(COMMSEC_TRADE).set_axis(details.index)  # Empty input loses the index otherwise
+
+    others = details[fields['Type'].isna()]
+    unparsed = others[others.str.contains(COMMSEC_TRADE_START)]
+    if len(unparsed):
+        rows = '\n'.join(f'\t{row}: {detail}' for row, detail in unparsed.items())
+        raise ValueError(f'Commsec trade details that could not be parsed:\n{rows}')
+
+    fields = fields[fields['Type'].notna()]
+
+    return pd.DataFrame({
+        'Type': fields['Type'],
+        'Volume': pd.to_numeric(fields['Volume']).astype('float64'),
+        'Ticker': fields['Ticker'],
+        'Price': pd.to_numeric(fields['Price']).astype('float64'),
+    }, index=fields.index)
+
+def to_master(raw_df):
+    trades = parse_details(raw_df['Details'])
+    tx_df = raw_df[['Date','Debit($)','Credit($)']].join(trades, how='inner')
+    tx_df[['Debit($)','Credit($)']] = tx_df[['Debit($)','Credit($)']].apply(pd.to_numeric)  # Exports are read as text
+    tx_df['Market'] = 'ASX'  # Commsec trades are ASX only
+
+    return tx_df
@@ -0,0 +1,64 @@
+'''Ingest throughput benchmark for broker adapters
+
+Tiles each broker's sample export in `transactions/samples` up to the same row count and times its adapter
+followed by `Loader.clean_df`, so every adapter is measured on the same amount of work.
+
+Run from the taxjinie folder with `python -m transactions.benchmark [rows]`
+'''
+from pathlib import Path
+import sys
+import time
+import pandas as pd
+import numpy as np
+
+# Local imports
+from . import brokers
+from .tx_loader import Loader
+
+SAMPLES_DIR = Path(__file__).parent / 'samples'
+TARGET_ROWS_PER_SEC = 100_000  # Every adapter should ingest at least this fast
+
+def sample_export(broker, rows):
+    '''Raw export of `rows` rows for `broker`, built by repeating its sample file
+    '''
+    samples = sorted(SAMPLES_DIR.glob(f'{broker}*.csv'))
+    if not samples:
+        raise FileNotFoundError(f'No sample export for {broker} in {SAMPLES_DIR}')
+
+    sample_df = pd.read_csv(samples[0], dtype=str)
+    return sample_df.iloc[np.resize(np.arange(len(sample_df)), rows)].reset_index(drop=True)
+
+def benchmark(broker_names=None, rows=1_000_000, repeat=3):
+    '''Times every adapter on `rows` raw rows and reports rows/sec against `TARGET_ROWS_PER_SEC`
+
+    Args:
+        broker_names (list, optional): Brokers to benchmark. Defaults to all registered adapters.
+        rows (int, optional): Raw rows per run. Defaults to 1_000_000.
+        repeat (int, optional): Runs per adapter, the fastest is reported. Defaults to 3.
+
+    Returns:
+        pandas.DataFrame: Index: Broker, Columns: [Rows, Seconds, Rows/sec, Meets target]
+    '''
+    loader = Loader()
+    results = []
+
+    for broker in broker_names or brokers.names():
+        adapter = brokers.get(broker)
+        raw_df = sample_export(broker, rows)
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            loader.clean_df(adapter.to_master(raw_df))
+            timings.append(time.perf_counter() - start)
+
+        results.append({'Broker': broker, 'Rows': rows, 'Seconds': min(timings), 'Rows/sec': rows / min(timings)})
+
+    results_df = pd.DataFrame(results).set_index('Broker')
+    results_df['Meets target'] = results_df['Rows/sec'] >= TARGET_ROWS_PER_SEC
+    print(results_df.to_string(float_format=lambda x: f'{x:,.2f}'))
+
+    return results_df
+
+if __name__ == '__main__':
+    benchmark(rows=int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,40 @@
+'''Registry of broker adapters
+
+An adapter is a module in `transactions/adapters` (or anything registered with `register`) exposing
+`to_master(raw_df)`, which maps the rows of one raw broker export to `TX_COLUMNS` with vectorised code.
+Raw exports are read as text, so adapters convert their own numeric columns. Raw rows are indexed by
+(File, Line) of their export and adapters keep that index, so ingest errors can point at the offending rows.
+Adapter modules are only imported when they are first used.
+'''
+from pathlib import Path
+import importlib
+import pkgutil
+
+ADAPTER_DIR = Path(__file__).parent / 'adapters'
+TX_COLUMNS = ['Date','Debit($)','Credit($)','Type','Volume','Ticker','Market','Price']
+
+_registry = {}
+
+def names():
+    '''Returns:
+        list: Broker names, i.e. registered adapters plus adapter modules found in `transactions/adapters`
+    '''
+    discovered = [module.name for module in pkgutil.iter_modules([str(ADAPTER_DIR)]) if not module.name.startswith('_')]
+    return sorted(set(discovered) | set(_registry))
+
+def register(name, adapter):
+    '''Registers an adapter for broker exports named `<name>*.csv`
+
+    Args:
+        name (str): Broker name
+        adapter: Object with a `to_master(raw_df)` callable, e.g. a module
+    '''
+    _registry[name] = adapter
+
+def get(name):
+    if name not in _registry:
+        if name not in names():
+            raise KeyError(f'No adapter for broker {name}. Available: {names()}')
+        register(name, importlib.import_module(f'{__package__}.adapters.{name}'))
+
+    return _registry[name]
@@ -0,0 +1,278 @@
+'''Columnar on-disk store for the master transaction table
+
+Each Australian financial year is a partition folder holding one `.npy` array per column plus a `meta.json`:
+
+    transactions/store/FY2021/Date.npy, Ticker.npy, Volume.npy, ..., meta.json
+
+Columns follow `SCHEMA`. Categorical (and any other string) columns are stored as integer codes with their
+labels in `meta.json`. Reads memory-map only the
+requested columns of the partitions that overlap the requested date range.
+
+Streaming ingests `spill` sorted runs in the same layout and `merge_runs` merges them block by block into
+memory-mapped partition files, so peak memory depends on the block size rather than the history size.
+'''
+from pathlib import Path
+import json
+import shutil
+import pandas as pd
+import numpy as np
+
+STORE_DIR = Path(__file__).parent / 'store'
+SPILL_DIR = Path(__file__).parent / '.spill'
+MERGE_BLOCK = 65536  # Rows read from each run per merge step
+
+# Compact dtypes of the master transaction table, in column order. Side is +1 for buys and -1 for sells
+SCHEMA = {
+    'Type': 'category',
+    'Side': 'int8',
+    'Volume': 'int32',
+    'Ticker': 'category',
+    'Market': 'category',
+    'Price': 'float64',
+    'PriceIncBrokerage': 'float64',
+}
+
+def financial_year(dates):
+    '''Australian financial year (ending 30 June) for each date
+
+    Args:
+        dates (pandas.DatetimeIndex): Dates to tag
+
+    Returns:
+        numpy.ndarray: FY end year per date, e.g. 2021-07-01 -> 2022
+    '''
+    dates = pd.DatetimeIndex(dates)
+    return dates.year.to_numpy() + (dates.month.to_numpy() > 6)
+
+def apply_schema(tx_df):
+    '''Casts a cleaned transaction table to `SCHEMA`
+
+    Raises:
+        ValueError: When a volume is not a whole number of units, listing those rows by their index labels, e.g.
+            (File, Line) of the raw export
+    '''
+    volumes = tx_df['Volume'].to_numpy(dtype='float64')
+    fractional = volumes != np.round(volumes)
+    if fractional.any():
+        rows = '\n'.join(
+            f'\t{label}: {volume:g} {ticker}'
+            for label, volume, ticker in zip(tx_df.index[fractional], volumes[fractional], tx_df['Ticker'][fractional])
+        )
+        raise ValueError(f'Volumes must be whole numbers of units, round these rows in the export:\n{rows}')
+
+    return tx_df.astype(SCHEMA)[list(SCHEMA)]
+
+def exists(store_dir=STORE_DIR):
+    return any(store_dir.glob('FY*/meta.json'))
+
+def partitions(store_dir=STORE_DIR):
+    '''Returns:
+        dict: {financial year: partition folder}, in year order
+    '''
+    return {int(meta.parent.name[2:]): meta.parent for meta in sorted(store_dir.glob('FY*/meta.json'))}
+
+def write(tx_df, store_dir=STORE_DIR):
+    '''Replaces the whole store with `tx_df` (Date indexed, as built by `Loader.clean_df`)
+    '''
+    if store_dir.exists():
+        shutil.rmtree(store_dir)
+    store_dir.mkdir(parents=True)
+
+    for year, fy_df in tx_df.groupby(financial_year(tx_df.index)):
+        _write_partition(fy_df, store_dir / f'FY{year}')
+
+def append(tx_df, store_dir=STORE_DIR):
+    '''Merges new transactions into the store, rewriting only the financial years they fall in
+    '''
+    existing = partitions(store_dir)
+
+    for year, fy_df in tx_df.groupby(financial_year(tx_df.index)):
+        if year in existing:
+            fy_df = pd.concat([_read_partition(existing[year]), fy_df])
+        _write_partition(fy_df, store_dir / f'FY{year}')
+
+def spill(tx_df, spill_dir=SPILL_DIR):
+    '''Writes a chunk of cleaned transactions as one sorted run per financial year, for `merge_runs`
+    '''
+    for year, fy_df in tx_df.groupby(financial_year(tx_df.index)):
+        runs = spill_dir / f'FY{year}'
+        _write_partition(fy_df, runs / f'run{len(list(runs.glob("run*"))):05d}')
+
+def merge_runs(spill_dir=SPILL_DIR, store_dir=STORE_DIR, replace=True, block=MERGE_BLOCK):
+    '''Merges spilled runs into the store and removes them
+
+    Args:
+        replace (bool, optional): Replace the whole store, otherwise existing partitions are merged in as one
+            more run. Defaults to True.
+        block (int, optional): Rows read from each run per merge step. Defaults to MERGE_BLOCK.
+    '''
+    existing = partitions(store_dir)
+    if replace:
+        for partition in existing.values():
+            shutil.rmtree(partition)
+        existing = {}
+
+    for runs in sorted(spill_dir.glob('FY*')):
+        year = int(runs.name[2:])
+        run_dirs = sorted(runs.glob('run*'))
+        if year in existing:
+            run_dirs.append(existing[year])
+
+        merged = store_dir / f'.merge_FY{year}'  # Not picked up by `partitions` until it is complete
+        _merge_partition(run_dirs, merged, block)
+
+        if year in existing:
+            shutil.rmtree(existing[year])
+        merged.rename(store_dir / f'FY{year}')
+
+    shutil.rmtree(spill_dir)
+
+def read(columns=None, start=None, end=None, store_dir=STORE_DIR):
+    '''Reads transactions from the store
+
+    Args:
+        columns (list, optional): Columns to load, Date is always the index. Defaults to all columns.
+        start (str or datetime, optional): First date to include. Defaults to None.
+        end (str or datetime, optional): Last date to include. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: Transactions in date order, buys on top for intra-day trades
+    '''
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end)
+    first_fy = None if start is None else financial_year([start])[0]
+    last_fy = None if end is None else financial_year([end])[0]
+
+    selected = [
+        partition for year, partition in partitions(store_dir).items()
+        if (first_fy is None or year >= first_fy) and (last_fy is None or year <= last_fy)
+    ]
+    if not selected:  # Typed like a stored table, so callers can compare and aggregate it as usual
+        empty_df = apply_schema(pd.DataFrame({column: [] for column in SCHEMA}, index=pd.DatetimeIndex([], name='Date')))
+        return empty_df if columns is None else empty_df[columns]
+
+    # One set of category labels across partitions keeps categorical columns categorical when concatenated
+    metas = [json.loads((partition / 'meta.json').read_text()) for partition in selected]
+    labels = {
+        column: pd.Index([label for meta in metas for label in meta['columns'][column]['labels']]).unique().sort_values()
+        for column in metas[0]['columns'] if 'labels' in metas[0]['columns'][column]
+    }
+
+    return pd.concat([_read_partition(partition, columns, start, end, labels) for partition in selected])
+
+def _write_partition(fy_df, partition):
+    fy_df = fy_df.sort_values(['Date','Volume'],ascending=[True,False])  # Must ensure buys sorted on top for intra-day trades
+
+    partition.mkdir(parents=True, exist_ok=True)
+    meta = {'rows': len(fy_df), 'columns': {}}
+
+    np.save(partition / 'Date.npy', fy_df.index.to_numpy(dtype='datetime64[ns]'))
+    for column in fy_df.columns:
+        values = fy_df[column]
+        if values.dtype == object or values.dtype.name == 'category':
+            codes, labels = pd.factorize(values, sort=True)
+            np.save(partition / f'{column}.npy', codes.astype('int32'))
+            meta['columns'][column] = {'dtype': 'category', 'labels': labels.tolist()}
+        else:
+            np.save(partition / f'{column}.npy', values.to_numpy())
+            meta['columns'][column] = {'dtype': str(values.dtype)}
+
+    (partition / 'meta.json').write_text(json.dumps(meta))
+
+def _read_partition(partition, columns=None, start=None, end=None, labels=None):
+    meta = json.loads((partition / 'meta.json').read_text())
+    columns = list(meta['columns']) if columns is None else columns
+
+    # Partitions are date sorted, so a date range is a contiguous row range
+    dates = np.load(partition / 'Date.npy', mmap_mode='r')
+    lo = 0 if start is None else np.searchsorted(dates, start.to_datetime64(), side='left')
+    hi = len(dates) if end is None else np.searchsorted(dates, end.to_datetime64(), side='right')
+
+    data = {}
+    for column in columns:
+        values = np.load(partition / f'{column}.npy', mmap_mode='r')[lo:hi]
+        partition_labels = meta['columns'][column].get('labels')
+        if partition_labels is None:
+            data[column] = np.array(values)
+        elif labels is None:
+            data[column] = pd.Categorical.from_codes(values, partition_labels)
+        else:
+            recode = np.append(labels[column].get_indexer(partition_labels), -1)  # Trailing -1 keeps missing values missing
+            data[column] = pd.Categorical.from_codes(recode[values], labels[column])
+
+    return pd.DataFrame(data, index=pd.DatetimeIndex(dates[lo:hi], name='Date'))
+
+def _merge_partition(run_dirs, partition, block):
+    # k-way merge of sorted runs, a block of rows per run at a time. Rows up to the smallest "last key" among the
+    # runs' current blocks are final, so they are sorted and written out before the blocks are refilled.
+    metas = [json.loads((run / 'meta.json').read_text()) for run in run_dirs]
+    columns = list(metas[0]['columns'])
+    total = sum(meta['rows'] for meta in metas)
+
+    partition.mkdir(parents=True, exist_ok=True)
+    meta = {'rows': total, 'columns': {}}
+    recode = {}
+    for column in columns:
+        if 'labels' in metas[0]['columns'][column]:
+            labels = pd.Index([label for run_meta in metas for label in run_meta['columns'][column]['labels']]).unique().sort_values()
+            recode[column] = [  # Trailing -1 keeps missing values (code -1) missing
+                np.append(labels.get_indexer(run_meta['columns'][column]['labels']), -1) for run_meta in metas
+            ]
+            meta['columns'][column] = {'dtype': 'category', 'labels': labels.tolist()}
+        else:
+            dtype = np.result_type(*[run_meta['columns'][column]['dtype'] for run_meta in metas])
+            meta['columns'][column] = {'dtype': str(dtype)}
+
+    runs = [
+        {column: np.load(run / f'{column}.npy', mmap_mode='r') for column in ['Date'] + columns}
+        for run in run_dirs
+    ]
+    out = {
+        column: np.lib.format.open_memmap(
+            partition / f'{column}.npy', mode='w+', shape=(total,),
+            dtype='int32' if column in recode else 'datetime64[ns]' if column == 'Date' else meta['columns'][column]['dtype'],
+        )
+        for column in ['Date'] + columns
+    }
+
+    cursors = [0] * len(runs)
+    written = 0
+    while written < total:
+        blocks = [(cursor, min(cursor + block, len(run['Date']))) for run, cursor in zip(runs, cursors)]
+        keys = [(run['Date'][lo:hi], -run['Volume'][lo:hi]) for run, (lo, hi) in zip(runs, blocks)]
+
+        # Runs with rows beyond their current block bound what can be emitted this step
+        bounds = [
+            (dates[-1], neg_volumes[-1])
+            for (dates, neg_volumes), run, (lo, hi) in zip(keys, runs, blocks) if hi < len(run['Date'])
+        ]
+        bound = min(bounds) if bounds else None
+
+        takes = []
+        for dates, neg_volumes in keys:
+            if bound is None:
+                takes.append(len(dates))
+            else:
+                takes.append(int(((dates < bound[0]) | ((dates == bound[0]) & (neg_volumes <= bound[1]))).sum()))
+
+        merged = {}
+        for column in ['Date'] + columns:
+            parts = []
+            for i, (run, (lo, _), take) in enumerate(zip(runs, blocks, takes)):
+                values = run[column][lo:lo + take]
+                parts.append(recode[column][i][values] if column in recode else values)
+            merged[column] = np.concatenate(parts)
+
+        order = np.lexsort((-merged['Volume'], merged['Date']))  # Buys sorted on top for intra-day trades
+        n = len(order)
+        for column in ['Date'] + columns:
+            out[column][written:written + n] = merged[column][order]
+
+        cursors = [cursor + take for cursor, take in zip(cursors, takes)]
+        written += n
+
+    for values in out.values():
+        values.flush()
+    del out, runs
+
+    (partition / 'meta.json').write_text(json.dumps(meta))
@@ -1,69 +1,228 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import shutil
 import pandas as pd
 import numpy as np
 
+# Local imports
+from . import brokers, store
+from .brokers import TX_COLUMNS
+
 DATA_DIR = Path(__file__).parent.parent / 'transactions'
 
+def row_fingerprints(raw_df, counter=None):
+    '''Stable per-row fingerprints of a raw export. Identical rows are told apart by their occurrence count,
+    so two genuine identical trades on the same day are both kept
+
+    Args:
+        raw_df (pandas.DataFrame): Raw export rows, read as text
+        counter (RowCounter, optional): Carries occurrence counts over from earlier chunks of the same file
+
+    Returns:
+        numpy.ndarray: uint64 fingerprint per row
+    '''
+    row_hashes = pd.util.hash_pandas_object(raw_df.astype(str), index=False).to_numpy()
+    occurrence = pd.Series(row_hashes).groupby(row_hashes).cumcount().to_numpy()
+    if counter is not None:
+        occurrence = occurrence + counter.update(row_hashes)
+
+    return pd.util.hash_pandas_object(
+        pd.DataFrame({'row': row_hashes, 'occurrence': occurrence}), index=False
+    ).to_numpy()
+
+class RowCounter():
+    '''Running count of row hashes seen in earlier chunks of one raw file
+    '''
+    def __init__(self):
+        self.hashes = np.array([], dtype='uint64')
+        self.counts = np.array([], dtype='int64')
+
+    def update(self, row_hashes):
+        '''Counts `row_hashes` in
+
+        Returns:
+            numpy.ndarray: How often each hash was seen before this chunk
+        '''
+        seen = np.zeros(len(row_hashes), dtype='int64')
+        if len(self.hashes):
+            pos = np.minimum(np.searchsorted(self.hashes, row_hashes), len(self.hashes) - 1)
+            found = self.hashes[pos] == row_hashes
+            seen[found] = self.counts[pos[found]]
+
+        hashes, inverse = np.unique(np.concatenate([self.hashes, row_hashes]), return_inverse=True)
+        weights = np.concatenate([self.counts, np.ones(len(row_hashes), dtype='int64')])
+        self.hashes, self.counts = hashes, np.bincount(inverse, weights=weights).astype('int64')
+
+        return seen
+
+def read_export(fpath):
+    '''Reads one raw export with its row fingerprints. Module level so it can run in a process pool
+    '''
+    raw_df = pd.read_csv(fpath, dtype=str)  # Text, so fingerprints do not depend on dtype inference
+    return label_rows(raw_df, fpath), row_fingerprints(raw_df)
+
+def label_rows(raw_df, fpath, first_line=2):
+    '''Indexes raw rows by (File, Line) in their export, so errors further down the ingest can point at them.
+    Line 1 is the header
+    '''
+    lines = np.arange(first_line, first_line + len(raw_df))
+    raw_df.index = pd.MultiIndex.from_product([[Path(fpath).name], lines], names=['File', 'Line'])
+    return raw_df
+
+def read_export_chunks(raw_paths, chunksize):
+    '''Streams raw export files in chunks of `chunksize` rows, with the same row fingerprints and the same
+    de-duplication across overlapping exports as `Loader.read_exports`
+
+    Yields:
+        tuple: (raw rows as a pandas.DataFrame, numpy.ndarray of their row fingerprints)
+    '''
+    earlier_files = np.array([], dtype='uint64')
+
+    for fpath in raw_paths:
+        counter = RowCounter()
+        file_fingerprints = []
+        line = 2
+
+        for raw_df in pd.read_csv(fpath, dtype=str, chunksize=chunksize):
+            fingerprints = row_fingerprints(raw_df, counter)
+            file_fingerprints.append(fingerprints)
+            raw_df, line = label_rows(raw_df, fpath, line), line + len(raw_df)
+
+            new_rows = ~np.isin(fingerprints, earlier_files)
+            yield raw_df[new_rows], fingerprints[new_rows]
+
+        earlier_files = np.union1d(earlier_files, np.concatenate(file_fingerprints))
+
 class Loader():
-    '''Reads txs and pickles them for later use
+    '''Reads txs and writes them to the columnar transaction store for later use
 
     Raises:
         IndexError: When no files are available from the broker
     '''
-    def __init__(self):
+    def __init__(self, data_dir=None):
         # self.broker = broker  # Use in future
 
         # Internal props
+        self.data_dir = DATA_DIR if data_dir is None else Path(data_dir)  # One portfolio's exports, store and ingest state
+        self.state_dir = self.data_dir / '.ingest'
         self.raw_files = {}
-        self.pkl_path = ''
+        self.store_path = self.data_dir / 'store'
         self.broker_dfs = {}
+        self.fingerprints = {}
     
-    def build(self):
-        self.broker_dfs['commsec'] = self.commsec()
+    def build(self, incremental=False, all_exports=False, workers=None, chunksize=None):
+        '''Builds the master transaction store from the latest raw broker and dividend files
 
-        master_tx_df = pd.DataFrame()
-        for broker in self.broker_dfs:
-            master_tx_df = pd.concat([master_tx_df, self.broker_dfs[broker]])
+        Args:
+            incremental (bool, optional): Only ingest raw rows that have not been ingested before and merge them
+                into the financial years they fall in. Falls back to a full rebuild when there is no ingest state.
+                Defaults to False.
+            all_exports (bool, optional): Read every export file for each source instead of only the latest one,
+                dropping rows repeated across overlapping exports. Defaults to False.
+            workers (int, optional): Processes used to read several export files. Defaults to the CPU count.
+            chunksize (int, optional): Stream raw files in chunks of this many rows, spilling each cleaned chunk
+                as sorted runs that are merged into the store at the end, so peak memory does not grow with the
+                file size. Defaults to None (read whole files).
+        '''
+        state = self.ingest_state() if incremental and store.exists(self.store_path) else {}
+        new_state = {}
+        raw_chunks = {}
 
-        dividends_df = self.scrip_dividends()
-        dividends_df = dividends_df[master_tx_df.columns]
+        for source in self.sources():
+            raw_paths = self.export_files(source, 'csv') if all_exports else [self.latest_file(source, 'csv')]
+            self.raw_files[source] = raw_paths[-1]
+            previous = state.get(source, {})
+            new_state[source] = {fpath.name: self.file_state(fpath, previous.get(fpath.name)) for fpath in raw_paths}
 
-        master_tx_df = pd.concat([master_tx_df, dividends_df])
-        master_tx_df = self.clean_df(master_tx_df)
+            changed = [  # Unchanged raw files --> nothing to ingest
+                fpath for fpath in raw_paths
+                if new_state[source][fpath.name]['sha256'] != previous.get(fpath.name, {}).get('sha256')
+            ]
+            if changed and chunksize:
+                raw_chunks[source] = read_export_chunks(changed, chunksize)
+            elif changed:
+                raw_chunks[source] = [self.read_exports(changed, workers)]
 
-        # Store output for other modules --> pickle is fine as raw is in .csv and will be used in Python only
-        # For future reference: https://towardsdatascience.com/stop-persisting-pandas-data-frames-in-csvs-f369a6440af5
-        fpath = DATA_DIR / 'portfolio'
-        self.pkl_path = fpath.with_suffix('.pkl')
-        master_tx_df.to_pickle(f"{self.pkl_path}")
-    
-    def commsec(self):
-        # need a builder factory
-        raw_df, self.raw_files['commsec'] = self.read_txs('commsec', 'csv')
+        if state and not raw_chunks:  # Skip parsing entirely when every raw file is unchanged
+            self.save_ingest_state(new_state)
+            print('Transactions up to date, nothing to ingest')
+            return
 
-        filtered_df = raw_df.loc[raw_df['Details'].str.startswith("B") | raw_df['Details'].str.startswith("S")]
+        frames = []
+        spill_dir = self.store_path.with_name('.spill')
+        if spill_dir.exists():  # Runs left over from an interrupted ingest
+            shutil.rmtree(spill_dir)
+        for source, chunks in raw_chunks.items():
+            ingested = self.ingested_rows(source) if source in state else np.array([], dtype='uint64')
+            source_fingerprints = [ingested]
 
-        tx_df = filtered_df[['Date','Debit($)','Credit($)']]
-            
-        # Note: Dataframe copy warning is fine, no values being written
-        tx_df[['Type','Volume','Ticker','Drop','Price']] = filtered_df['Details'].str.split(expand = True)
-        cols = ['Volume', 'Price']
-        tx_df[cols] = tx_df[cols].apply(pd.to_numeric, downcast='float')
+            for raw_df, fingerprints in chunks:
+                new_rows = ~np.isin(fingerprints, ingested)
+                source_fingerprints.append(fingerprints[new_rows])
 
-        return tx_df
+                tx_df = self.clean_df(self.master_rows(source, raw_df[new_rows]))
+                if chunksize:
+                    store.spill(tx_df, spill_dir)
+                else:
+                    frames.append(tx_df)
+
+            self.fingerprints[source] = np.unique(np.concatenate(source_fingerprints))
+
+        # Store output for other modules as one column file per financial year (see store.py)
+        if chunksize:
+            if spill_dir.exists():
+                store.merge_runs(spill_dir, self.store_path, replace=not state)
+        elif state:
+            master_tx_df = pd.concat(frames)
+            if len(master_tx_df):
+                store.append(master_tx_df, self.store_path)
+                print(f'Ingested {len(master_tx_df)} new transactions\n\tOutput path:\t{self.store_path}')
+        else:
+            store.write(pd.concat(frames), self.store_path)
+
+        self.save_ingest_state(new_state)
+
+    def sources(self):
+        '''Returns:
+            list: Brokers with an adapter and at least one export file, followed by dividends
+        '''
+        broker_names = [broker for broker in brokers.names() if any(self.data_dir.glob(f'{broker}*csv'))]
+        if not broker_names:
+            raise IndexError(f'No tx files from any broker. Supported brokers: {brokers.names()}')
+
+        return broker_names + ['dividends']
+
+    def master_rows(self, source, raw_df):
+        '''Maps raw rows of one source to the master transaction columns
+        '''
+        if source == 'dividends':
+            return self.scrip_dividends(raw_df)[TX_COLUMNS]
+
+        self.broker_dfs[source] = self.broker_txs(source, raw_df)
+        return self.broker_dfs[source][TX_COLUMNS]
+
+    def broker_txs(self, broker, raw_df=None):
+        '''Maps a raw broker export to the master transaction columns with the broker's adapter (see brokers.py)
+        '''
+        if raw_df is None:
+            raw_df, self.raw_files[broker] = self.read_txs(broker, 'csv')
+
+        return brokers.get(broker).to_master(raw_df)
 
     def clean_df(self, tx_df):
         # Clean dataframe --> Update data types, calculate final columns, drop useless columns, set index as date
-        tx_df['txValue'] = tx_df.fillna(0)['Debit($)'] + tx_df.fillna(0)['Credit($)']
-        tx_df['PriceIncBrokerage'] = np.abs( tx_df['txValue'] / tx_df['Volume'] )
-        tx_df['Volume'] = np.where(
-            tx_df['Type'] == 'B'
-            , tx_df['Volume']
-            , -1 * tx_df['Volume']
+        tx_value = tx_df['Debit($)'].fillna(0) + tx_df['Credit($)'].fillna(0)
+        side = np.where(tx_df['Type'] == 'B', 1, -1)
+        tx_df = tx_df.assign(
+            PriceIncBrokerage = np.abs(tx_value / tx_df['Volume']),
+            Side = side,
+            Volume = side * tx_df['Volume'],
+            Date = pd.to_datetime(tx_df['Date'], dayfirst=True),
         )
-        tx_df = tx_df.drop(columns=['Drop','Debit($)','Credit($)', 'txValue'])
-        tx_df['Date'] = pd.to_datetime(tx_df['Date'], dayfirst=True)
-        tx_df = tx_df.set_index('Date')
+        # Compact dtypes, see store.SCHEMA. Applied while rows are still labelled by their raw export line
+        tx_df = store.apply_schema(tx_df).set_index(pd.DatetimeIndex(tx_df['Date'], name='Date'))
         tx_df = tx_df.sort_values(['Date','Volume'],ascending=[True,False])  # Must ensure buys sorted on top for intra-day trades
 
         return tx_df
@@ -71,17 +230,78 @@ class Loader():
     def read_txs(self,broker, filetype='csv'):
         ## READ CSV FILE --> convert to function later
         # This could also be generalised to any broker in future
-        csvfiles = sorted(list(DATA_DIR.glob(f'{broker}*{filetype}')))
-
-        try: latest_csv = csvfiles[-1]
-        except IndexError:
-            raise IndexError(f'No tx files from {broker}')
+        latest_csv = self.latest_file(broker, filetype)
 
         ## Read file and return as dataframe
         return (pd.read_csv(latest_csv), latest_csv)
+
+    def latest_file(self, broker, filetype='csv'):
+        return self.export_files(broker, filetype)[-1]
+
+    def export_files(self, broker, filetype='csv'):
+        csvfiles = sorted(list(self.data_dir.glob(f'{broker}*{filetype}')))
+
+        if not csvfiles:
+            raise IndexError(f'No tx files from {broker}')
+
+        return csvfiles
+
+    def read_exports(self, raw_paths, workers=None):
+        '''Reads raw export files, in a process pool when there are several, and keeps the first copy of rows
+        repeated across overlapping exports or accounts
+
+        Returns:
+            tuple: (raw rows as a pandas.DataFrame, numpy.ndarray of their row fingerprints)
+        '''
+        if len(raw_paths) == 1:
+            exports = [read_export(raw_paths[0])]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                exports = list(pool.map(read_export, raw_paths))
+
+        raw_df = pd.concat([raw_df for raw_df, _ in exports])
+        fingerprints = np.concatenate([fingerprints for _, fingerprints in exports])
+
+        _, first = np.unique(fingerprints, return_index=True)
+        first.sort()  # Keep export order
+
+        return raw_df.iloc[first], fingerprints[first]
+
+    def file_state(self, fpath, previous=None):
+        '''Fingerprints a raw file. The content hash is reused from `previous` when size and mtime are unchanged
+
+        Returns:
+            dict: Keys: [size, mtime_ns, sha256]
+        '''
+        stat = fpath.stat()
+        file_state = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+        if previous and all(previous[key] == file_state[key] for key in ['size', 'mtime_ns']):
+            file_state['sha256'] = previous['sha256']
+        else:
+            file_state['sha256'] = hashlib.sha256(fpath.read_bytes()).hexdigest()
+
+        return file_state
+
+    def ingest_state(self):
+        try:
+            return json.loads(self.state_dir.joinpath('state.json').read_text())
+        except FileNotFoundError:
+            return {}
+
+    def ingested_rows(self, source):
+        return np.load(self.state_dir / f'{source}.npy')
+
+    def save_ingest_state(self, new_state):
+        self.state_dir.mkdir(exist_ok=True)
+        for source, fingerprints in self.fingerprints.items():
+            np.save(self.state_dir / f'{source}.npy', fingerprints)
+
+        self.state_dir.joinpath('state.json').write_text(json.dumps(new_state, indent=2))
     
-    def scrip_dividends(self):
-        raw_df, self.raw_files['dividends'] = self.read_txs('dividends', 'csv')
+    def scrip_dividends(self, raw_df=None):
+        if raw_df is None:
+            raw_df, self.raw_files['dividends'] = self.read_txs('dividends', 'csv')
 
         temp_df = raw_df[raw_df['scrip_vol'].isna() == False]
 
@@ -92,6 +312,7 @@ class Loader():
             ,'scrip_vol':'Volume'
             ,'scrip_price':'Price'
         })
+        temp_df[['Volume','Price']] = temp_df[['Volume','Price']].apply(pd.to_numeric)  # Exports are read as text
         temp_df['Market'] = 'ASX'
         temp_df['PriceIncBrokerage'] = temp_df['Price']
         temp_df['Type'] = 'B'
@@ -99,6 +320,5 @@ class Loader():
         # Adding columns to align with broker
         temp_df['Credit($)'] = 0
         temp_df['Debit($)'] = 0
-        temp_df['Drop'] = ''
 
         return temp_df
\ No newline at end of file
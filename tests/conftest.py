@@ -0,0 +1,53 @@
+'''Shared fixtures. taxjinie runs as a script folder, so its modules are imported the way `python taxjinie` does
+'''
+from pathlib import Path
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'taxjinie'))
+
+# Local imports
+from transactions import store  # noqa: E402
+from analysis import portfolio  # noqa: E402
+
+# Date, ticker, signed volume, price. Brokerage is left out, so PriceIncBrokerage is the price
+TRADES = [
+    ('2019-08-01', 'RBL', 830, 2.0),
+    ('2020-03-02', 'DRO', 10000, 0.10),
+    ('2020-09-10', 'DRO', 24931, 0.125),
+    ('2021-04-22', 'DEM', 107142, 0.28),
+    ('2021-05-03', 'RBL', -830, 4.05),
+    ('2021-05-03', 'DRO', -26216, 0.185),
+    ('2021-07-05', 'DRO', -5000, 0.2),
+    ('2021-08-02', 'DEM', 1000, 0.3),
+]
+
+def transactions_frame(trades):
+    '''Transactions in the store's schema, Date indexed'''
+    dates, tickers, volumes, prices = zip(*trades) if trades else ([], [], [], [])
+    volumes = np.asarray(volumes, dtype='int64')
+    tx_df = pd.DataFrame({
+        'Type': np.where(volumes > 0, 'B', 'S'),
+        'Side': np.sign(volumes),
+        'Volume': volumes,
+        'Ticker': list(tickers),
+        'Market': 'ASX',
+        'Price': np.asarray(prices, dtype='float64'),
+        'PriceIncBrokerage': np.asarray(prices, dtype='float64'),
+    }, index=pd.DatetimeIndex(pd.to_datetime(list(dates)), name='Date'))
+    return store.apply_schema(tx_df)
+
+@pytest.fixture
+def data_dir(tmp_path):
+    '''Portfolio data folder with a store of TRADES'''
+    store.write(transactions_frame(TRADES), tmp_path / 'store')
+    yield tmp_path
+    portfolio.clear_cache()
+
+@pytest.fixture
+def empty_dir(tmp_path):
+    '''Portfolio data folder with nothing ingested yet'''
+    yield tmp_path
+    portfolio.clear_cache()
@@ -0,0 +1,32 @@
+import pandas as pd
+
+# Local imports
+from analysis import portfolio
+
+def test_transactions_before_the_first_partition_keep_the_schema(data_dir):
+    txs_df = portfolio.transactions(end='2015-01-01', data_dir=data_dir)
+
+    assert txs_df.empty
+    assert txs_df.dtypes.astype(str).equals(portfolio.transactions(data_dir=data_dir).dtypes.astype(str))
+
+def test_transactions_of_an_empty_store(empty_dir):
+    txs_df = portfolio.transactions(['Ticker', 'Volume'], data_dir=empty_dir)
+
+    assert txs_df.empty
+    assert list(txs_df.columns) == ['Ticker', 'Volume']
+    assert txs_df['Volume'].dtype == 'int32'
+
+def test_positions_before_the_first_trade(data_dir):
+    positions_df = portfolio.positions(as_of='2015-01-01', data_dir=data_dir)
+
+    assert positions_df.empty
+    assert list(positions_df.columns) == ['Value', 'Cash in', 'Cash out', 'Volume', 'PriceIncBrokerage']
+
+def test_positions_of_an_empty_store(empty_dir):
+    assert portfolio.positions(current=True, data_dir=empty_dir).empty
+
+def test_positions(data_dir):
+    positions_df = portfolio.positions(as_of='2021-06-30', data_dir=data_dir)
+
+    assert positions_df['Volume'].to_dict() == {'DEM': 107142, 'DRO': 8715, 'RBL': 0}
+    assert positions_df.loc['RBL', 'Value'] == pd.Series([830 * 2.0, -830 * 4.05]).sum()
@@ -0,0 +1,23 @@
+import pandas as pd
+
+# Local imports
+from analysis import returns
+from analysis.holdings import Holdings
+from conftest import TRADES, transactions_frame
+
+def test_summary_without_history_is_empty(data_dir):
+    time_weighted = returns.TimeWeightedReturns.from_store(end='2015-01-01', data_dir=data_dir)
+
+    assert time_weighted.summary().empty
+    assert time_weighted.to_date().isna().all()
+
+def test_returns_over_days_without_a_price_are_nan():
+    txs_df = transactions_frame(TRADES)
+    prices = pd.DataFrame({'DRO': [0.2, 0.25], 'RBL': [3.0, 3.5]}, index=pd.to_datetime(['2020-01-01', '2021-01-01']))
+    time_weighted = returns.TimeWeightedReturns(Holdings(txs_df), txs_df, prices)
+
+    # DEM has no price once it is bought on 2021-04-22, which also leaves the portfolio unvalued
+    summary_df = time_weighted.summary(as_of='2021-05-31')
+    assert summary_df.loc['MTD', ['DEM', 'Portfolio']].isna().all()
+    assert summary_df.loc['MTD', ['DRO', 'RBL']].notna().all()
+    assert time_weighted.between('2021-03-01', '2021-04-21').notna().all()
@@ -0,0 +1,63 @@
+import pytest
+
+# Local imports
+from analysis import tax
+from conftest import transactions_frame
+
+SAME_DAY_SALES = [
+    ('2019-08-01', 'RBL', 100, 1.0),
+    ('2020-02-03', 'RBL', 100, 2.0),
+    ('2021-05-03', 'RBL', -30, 3.0),
+    ('2021-05-03', 'RBL', -50, 3.0),
+]
+
+def buy_dates(tax_reporting):
+    links_df = tax_reporting.audit.link_frame()
+    return links_df.groupby('Sale')['Buy Date'].apply(lambda dates: sorted(dates.dt.strftime('%Y-%m-%d')))
+
+def test_specific_lots_for_each_of_two_same_day_sales():
+    tax_reporting = tax.Tax(2021, transactions=transactions_frame(SAME_DAY_SALES))
+    tax_reporting.capital_gain_events(method='specific', selections={
+        ('RBL', '2021-05-03', 0): ['2019-08-01'],
+        ('RBL', '2021-05-03', 1): ['2019-08-01'],
+    })
+
+    assert buy_dates(tax_reporting).tolist() == [['2019-08-01'], ['2019-08-01']]
+
+def test_same_day_sales_need_a_sale_number():
+    tax_reporting = tax.Tax(2021, transactions=transactions_frame(SAME_DAY_SALES))
+
+    with pytest.raises(ValueError, match='2 sales of RBL'):
+        tax_reporting.capital_gain_events(method='specific', selections={('RBL', '2021-05-03'): ['2019-08-01']})
+    with pytest.raises(ValueError, match='No sale 2 of RBL'):
+        tax_reporting.capital_gain_events(method='specific', selections={('RBL', '2021-05-03', 2): ['2019-08-01']})
+
+def test_upcoming_discounts_use_the_lots_open_on_the_day(data_dir):
+    tax_reporting = tax.Tax(2021, data_dir=data_dir)
+    upcoming_df = tax_reporting.upcoming_cgtdiscounts(days=3650, as_of='2021-01-01')
+
+    # DEM was bought after the day and the DRO and RBL sales came after it
+    assert upcoming_df.groupby('Ticker', observed=True)['Volume'].sum().to_dict() == {'DRO': 34931}
+    assert tax_reporting.discount_index('2021-01-01').eligible('2021-01-01')['Ticker'].tolist() == ['RBL']
+
+def test_discount_index_rejects_days_before_its_lots(data_dir):
+    index = tax.Tax(2021, data_dir=data_dir).discount_index()
+
+    assert index.eligible('2021-06-30')['Ticker'].tolist() == ['DRO']
+    with pytest.raises(ValueError, match='Lots are open as of 2021-05-03'):
+        index.eligible('2021-01-01')
+
+def test_simulated_sales_use_the_lots_open_on_the_day(data_dir):
+    tax_reporting = tax.Tax(2022, data_dir=data_dir)
+
+    # 8715 DRO were left after the FY2021 sale, 5000 more were sold on 2021-07-05
+    fy_end_df = tax_reporting.simulate_sale('DRO', 8715, 0.3, as_of='2021-06-30')
+    assert fy_end_df.loc['LIFO', 'Cost'] == pytest.approx(871.5)
+    assert fy_end_df.loc['LIFO', 'Capital Gains Taxable'] == pytest.approx(871.5)
+    with pytest.raises(ValueError, match='3715 are held'):
+        tax_reporting.simulate_sale('DRO', 8715, 0.3, as_of='2021-07-10')
+    assert tax_reporting.simulate_sale('RBL', 830, 5.0, as_of='2021-05-02').loc['LIFO', 'Cost'] == pytest.approx(1660)
+
+def test_simulated_sales_after_the_loaded_history_raise(data_dir):
+    with pytest.raises(ValueError, match='use Tax\\(2022\\)'):
+        tax.Tax(2021, data_dir=data_dir).simulate_sale('DRO', 100, 0.3, as_of='2021-07-10')